@@ -8,6 +8,8 @@ and update assembly data.
 Get the JSON file with:
 datasets summary genome taxon 147537 | python -m json.tool > [filename].json
 (using datasets installed through conda, version 12.30.0
+or, for very large taxa, as JSON lines (one report per line) with:
+datasets summary genome taxon 4751 --as-json-lines > [filename].jsonl
 
 The script is designed to be able to update the folder with downloaded assemblies when using newer json files
 
@@ -17,16 +19,24 @@ This version of the script incorporates a skip list and updates the ncbi-dataset
 import sys
 import os
 import json
+import re
 import argparse
 from pathlib import Path
 import subprocess
 from subprocess import STDOUT
 import zipfile as zip
+import time
+import tempfile
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from zip_manifest import ZipManifest
 
 def command_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-j", "--json", help="JSON file downloaded with NCBI \
-                        datasets with assembly data", required=True,
+                        datasets with assembly data. Can also be a JSON lines \
+                        file (datasets summary --as-json-lines)", required=True,
                         type=Path)
     parser.add_argument("-t", "--tries", help="Try this many times to get each\
                         accession file. If it still fails, a warning will be \
@@ -40,42 +50,240 @@ def command_parser():
                         download accessions from this list")
     parser.add_argument("--skiplist", type=Path, help="If present, use this \
                         list of accessions to be skipped during the downloading")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of \
+                        simultaneous downloads. Default: 1")
+    parser.add_argument("--backoff", type=float, default=0.0, help="Seconds \
+                        to wait after the first failed try of an accession. \
+                        The waiting time doubles after each failed try. \
+                        Successful downloads never wait. Default: 0 (retry \
+                        right away)")
+    parser.add_argument("--batch", type=int, default=1, help="Download this \
+                        many accessions with each datasets call. The package \
+                        is then split into one zip file per accession. \
+                        Accessions from a failed batch are downloaded one by \
+                        one. Default: 1 (no batches)")
 
     return parser.parse_args()
 
 
-def download_accession(acc, tries, outputfolder):
+def download_accession(acc, tries, outputfolder, manifest, backoff=0.0, quiet=False):
+    """
+    Download one accession, trying up to 'tries' times. After each failed
+    try, wait 'backoff' seconds (doubled every time) before trying again.
+    Use 'quiet' to hide the progress bar when several downloads run together.
+    Valid zip files are recorded in the manifest
+    """
     zipfilename = outputfolder / (acc + ".zip")
 
     cmd = ["datasets", "download", "genome", "accession"]
     cmd.append(acc)
     cmd.append("--filename")
     cmd.append(str(zipfilename))
+    if quiet:
+        cmd.append("--no-progressbar")
     # print(" ".join(cmd))
     
     for n in range(tries):
+        if n > 0 and backoff > 0:
+            time.sleep(backoff * 2**(n-1))
+
         proc = subprocess.run(cmd, stderr=STDOUT, encoding="utf-8")
         try:
             proc.check_returncode()
         except subprocess.CalledProcessError:
-            print("Error downloading {} (try {}/{})".format(acc, n, tries))
-            print(proc.stderr)
+            print("Error downloading {} (try {}/{})".format(acc, n+1, tries))
         else:
             zipfilename = outputfolder / (acc + ".zip")
             # check here if file already exists (it should)
             if zipfilename.is_file():
                 # and whether it can be unzipped
-                try:
-                    z = zip.ZipFile(zipfilename, "r")
-                except zip.BadZipFile:
+                if manifest.add(zipfilename) is None:
                     print("Error with zip file for {}".format(acc))
                 else:
-                    z.close()
                     return True
     print("Could not get {}. Try again (and possibly increase number of tries)".format(acc))
     return False
 
 
+def read_reports(json_file, chunk_size=1024*1024):
+    """
+    Yields the entries of "reports" one by one, without loading the whole
+    file in memory. Accepts both the (pretty-printed or not) JSON document and
+    the output of 'datasets summary --as-json-lines'
+    """
+    decoder = json.JSONDecoder()
+
+    with open(json_file) as f:
+        buffer = f.read(chunk_size)
+
+        # JSON lines: the first line is already a complete report
+        first_line = buffer.split("\n", 1)[0]
+        try:
+            record = json.loads(first_line)
+        except ValueError:
+            record = None
+        if isinstance(record, dict) and "reports" not in record:
+            f.seek(0)
+            for line in f:
+                if line.strip() == "":
+                    continue
+                yield json.loads(line)
+            return
+
+        # JSON document: find the start of the "reports" array...
+        start = None
+        while start is None:
+            match = re.search(r'"reports"\s*:\s*\[', buffer)
+            if match:
+                start = match.end()
+                break
+            more = f.read(chunk_size)
+            if not more:
+                return
+            # keep the tail in case the key is split between chunks
+            buffer = buffer[-64:] + more
+
+        # ...and decode one report at a time
+        pos = start
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            try:
+                report, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # report is incomplete (or we ran out of buffer)
+                more = f.read(chunk_size)
+                if not more:
+                    if buffer[pos:].strip() == "":
+                        return
+                    raise
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+
+            yield report
+            pos = end
+            # discard what was already decoded once in a while
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def shared_member(name, data, acc, accs):
+    """
+    Contents of a package file that is not inside an accession folder (e.g.
+    README.md or the data report), restricted to one accession where the
+    file lists several
+    """
+    if name == "ncbi_dataset/data/assembly_data_report.jsonl":
+        lines = [line for line in data.decode("utf-8").splitlines() 
+            if line.strip() and json.loads(line).get("accession") == acc]
+        return "".join(line + "\n" for line in lines).encode("utf-8")
+
+    if name == "ncbi_dataset/data/dataset_catalog.json":
+        catalog = json.loads(data.decode("utf-8"))
+        catalog["assemblies"] = [x for x in catalog.get("assemblies", list())
+            if x.get("accession", acc) == acc]
+        return json.dumps(catalog, indent=2).encode("utf-8")
+
+    if name == "md5sum.txt":
+        others = ["ncbi_dataset/data/{}/".format(x) for x in accs if x != acc]
+        lines = [line for line in data.decode("utf-8").splitlines() 
+            if not any(other in line for other in others)]
+        return "".join(line + "\n" for line in lines).encode("utf-8")
+
+    return data
+
+
+def split_package(package, accs, outputfolder, manifest):
+    """
+    Split a datasets package with several accessions into one zip file per
+    accession, with the same internal layout as a single-accession download:
+    the accession folder, plus the package files (README.md, data report and
+    catalog) restricted to that accession.
+    Returns the set of accessions that were written (and recorded in the 
+    manifest)
+    """
+    written = set()
+
+    with zip.ZipFile(package) as z:
+        members = defaultdict(list)
+        shared = list() # (info, contents) of files outside accession folders
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            # e.g. ncbi_dataset/data/GCA_000002515.1/GCA_000002515.1_ASM251v1_genomic.fna
+            parts = info.filename.split("/")
+            if len(parts) >= 4 and parts[:2] == ["ncbi_dataset", "data"]:
+                if parts[2] in accs:
+                    members[parts[2]].append(info)
+            else:
+                shared.append((info, z.read(info)))
+
+        for acc in accs:
+            if not members[acc]:
+                continue
+
+            zipfilename = outputfolder / (acc + ".zip")
+            # write to a temporary name first so that an interrupted split
+            # doesn't leave a valid-looking but incomplete zip file
+            partial = outputfolder / (acc + ".zip.part")
+            try:
+                with zip.ZipFile(partial, "w") as out:
+                    for info, data in shared:
+                        contents = shared_member(info.filename, data, acc, accs)
+                        if contents is not None:
+                            out.writestr(info, contents)
+                    for info in members[acc]:
+                        with z.open(info) as source, out.open(info, "w") as target:
+                            shutil.copyfileobj(source, target, 1024*1024)
+                os.replace(partial, zipfilename)
+            except BaseException:
+                if partial.exists():
+                    partial.unlink()
+                raise
+            if manifest.add(zipfilename) is not None:
+                written.add(acc)
+
+    return written
+
+
+def download_batch(accs, outputfolder, manifest, quiet=False):
+    """
+    Download a list of accessions with a single datasets call and split the
+    result into per-accession zip files.
+    Returns the set of accessions that were written
+    """
+    with tempfile.TemporaryDirectory(prefix=".batch_", dir=outputfolder) as tmp:
+        tmp = Path(tmp)
+        accession_list = tmp / "accessions.txt"
+        package = tmp / "package.zip"
+        with open(accession_list, "w") as f:
+            f.write("\n".join(accs) + "\n")
+
+        cmd = ["datasets", "download", "genome", "accession"]
+        cmd.extend(["--inputfile", str(accession_list)])
+        cmd.extend(["--filename", str(package)])
+        if quiet:
+            cmd.append("--no-progressbar")
+
+        proc = subprocess.run(cmd, stderr=STDOUT, encoding="utf-8")
+        try:
+            proc.check_returncode()
+        except subprocess.CalledProcessError:
+            print("Error downloading batch {}..{}".format(accs[0], accs[-1]))
+            return set()
+
+        try:
+            return split_package(package, set(accs), outputfolder, manifest)
+        except (zip.BadZipFile, IOError, ValueError):
+            print("Error with zip file for batch {}..{}".format(accs[0], accs[-1]))
+            return set()
+
+
 if __name__ == "__main__":
     options = command_parser()
 
@@ -87,6 +295,11 @@ if __name__ == "__main__":
     if not o.is_dir():
         os.makedirs(o, exist_ok=True)
 
+    if options.jobs < 1:
+        sys.exit("Error: --jobs must be at least 1")
+    if options.batch < 1:
+        sys.exit("Error: --batch must be at least 1")
+
     skip_set = set()
     if options.skiplist:
         with open(options.skiplist) as f:
@@ -98,53 +311,99 @@ if __name__ == "__main__":
         with open(options.includelist) as f:
             include_set = set(x.strip() for x in f.readlines())
 
-    accession_metadata_summary = list()
-    with open(json_file) as f, open(o / "updated_assemblies.tsv", "w") as u:
-        j = json.load(f)
+    # size, mtime and contents of the zip files that were already checked
+    manifest = ZipManifest(o)
 
-        for n, asm in enumerate(j["reports"]):
-            if options.n:
-                if n+1 > options.n:
-                    break
+    quiet = options.jobs > 1
+    download_single = lambda acc: download_accession(acc, options.tries, o, 
+        manifest, options.backoff, quiet)
+    download_several = lambda accs: download_batch(accs, o, manifest, quiet)
 
-            # asm = item["assembly"]
+    # Downloads are submitted while the JSON file is still being read.
+    # (metadata, future or None if already downloaded) in the order of the 
+    # JSON file
+    accession_list = list()
+    batch_futures = list()
+    pending_batch = list()
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        with open(o / "updated_assemblies.tsv", "w") as u:
+            for n, asm in enumerate(read_reports(json_file)):
+                if options.n:
+                    if n+1 > options.n:
+                        break
 
-            asm_ac = asm["accession"]
-            org = asm["organism"]
-            sci_name = org["organism_name"]
-            infraspecific_names = org.get("infraspecific_names", "")
-            if infraspecific_names:
-                strain = infraspecific_names.get("strain", "")
-            tax_id = str(org.get("tax_id", ""))
+                # asm = item["assembly"]
 
-            # only download accessions from include_set (if present)
-            if include_set and asm_ac not in include_set:
-                continue
+                asm_ac = asm["accession"]
+                org = asm["organism"]
+                sci_name = org["organism_name"]
+                infraspecific_names = org.get("infraspecific_names", "")
+                strain = ""
+                if infraspecific_names:
+                    strain = infraspecific_names.get("strain", "")
+                tax_id = str(org.get("tax_id", ""))
 
-            # skip accessions if they're in skip_set
-            if asm_ac in skip_set:
-                continue
-            # check no. 2: see if we had a previous version of the assembly
-            asm_ac_no_ver = asm_ac.split(".")[0]
-            if asm_ac_no_ver in skip_set_no_version:
-                print("Got {}. Had {}".format(asm_ac, skip_set_no_version[asm_ac_no_ver]))
-                u.write("{}\t{}\n".format(asm_ac, skip_set_no_version[asm_ac_no_ver]))
-
-            zipfilename = o / (asm_ac + ".zip")
-            # check here if file already exists
-            if zipfilename.is_file():
-                # and whether it can be unzipped
-                try:
-                    z = zip.ZipFile(zipfilename, "r")
-                except zip.BadZipFile:
-                    print(" Warning: Zip error for {}, re-downloading")
-                else:
-                    z.close()
-                    accession_metadata_summary.append((asm_ac, tax_id, sci_name, strain))
+                # only download accessions from include_set (if present)
+                if include_set and asm_ac not in include_set:
+                    continue
+
+                # skip accessions if they're in skip_set
+                if asm_ac in skip_set:
                     continue
+                # check no. 2: see if we had a previous version of the assembly
+                asm_ac_no_ver = asm_ac.split(".")[0]
+                if asm_ac_no_ver in skip_set_no_version:
+                    print("Got {}. Had {}".format(asm_ac, skip_set_no_version[asm_ac_no_ver]))
+                    u.write("{}\t{}\n".format(asm_ac, skip_set_no_version[asm_ac_no_ver]))
+
+                metadata = (asm_ac, tax_id, sci_name, strain)
+                zipfilename = o / (asm_ac + ".zip")
+                # check here if file already exists
+                if zipfilename.is_file():
+                    # and whether it can be unzipped (only opened if the file
+                    # changed since it was recorded in the manifest)
+                    if manifest.check(zipfilename) is None:
+                        print(" Warning: Zip error for {}, re-downloading".format(asm_ac))
+                    else:
+                        accession_list.append((metadata, None))
+                        continue
+
+                if options.batch > 1:
+                    accession_list.append((metadata, len(batch_futures)))
+                    pending_batch.append(asm_ac)
+                    if len(pending_batch) == options.batch:
+                        batch_futures.append(executor.submit(download_several, pending_batch))
+                        pending_batch = list()
+                else:
+                    accession_list.append((metadata, executor.submit(download_single, asm_ac)))
+
+        if pending_batch:
+            batch_futures.append(executor.submit(download_several, pending_batch))
+
+        # Batch mode: anything not obtained in a package gets downloaded 
+        # individually
+        if options.batch > 1:
+            obtained = set()
+            for future in batch_futures:
+                obtained.update(future.result())
+
+            missing = [metadata[0] for metadata, b in accession_list if 
+                b is not None and metadata[0] not in obtained]
+            if missing:
+                print("{} accessions not obtained in batches. Downloading them one by one".format(len(missing)))
+            retried = {acc: executor.submit(download_single, acc) for acc in missing}
+
+            for n, (metadata, b) in enumerate(accession_list):
+                if b is None or metadata[0] in obtained:
+                    accession_list[n] = (metadata, None)
+                else:
+                    accession_list[n] = (metadata, retried[metadata[0]])
+
+        # results are collected in the order of the JSON file
+        accession_metadata_summary = [metadata for metadata, future in 
+            accession_list if future is None or future.result()]
 
-            if download_accession(asm_ac, options.tries, o):
-                accession_metadata_summary.append((asm_ac, tax_id, sci_name, strain))
+    manifest.save()
 
     with open(o/"metadata.tsv", "w") as f:
         f.write("\n".join(["\t".join(x) for x in accession_metadata_summary]))
@@ -22,11 +22,40 @@ import argparse
 from pathlib import Path
 import subprocess
 from subprocess import STDOUT
-from zipfile import ZipFile, BadZipFile, is_zipfile, ZIP_DEFLATED
-from multiprocessing import Pool, cpu_count
+from zipfile import ZipFile, BadZipFile, is_zipfile, ZIP_DEFLATED, ZIP_STORED, \
+    ZIP_BZIP2, ZIP_LZMA
+try:
+    from zipfile import ZIP_ZSTANDARD
+except ImportError:
+    ZIP_ZSTANDARD = None
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import Pool, Manager, cpu_count
 import tempfile
+import threading
+import math
+import time
 import io
-from shutil import rmtree
+import shlex
+from shutil import rmtree, copyfileobj
+from zip_manifest import ZipManifest
+from busco_archive import ARCHIVE_NAME, BuscoArchive, pack_run
+
+# bytes copied at a time when uncompressing genomes
+STAGING_BUFFER = 4 * 1024 * 1024
+
+# --compression choices. zstd only with Python >= 3.14 (steps 3-6 then need
+# the same Python version to read the results)
+COMPRESSION_METHODS = {"deflate": ZIP_DEFLATED, "store": ZIP_STORED, 
+    "bzip2": ZIP_BZIP2, "lzma": ZIP_LZMA}
+if ZIP_ZSTANDARD is not None:
+    COMPRESSION_METHODS["zstd"] = ZIP_ZSTANDARD
+
+# state of each job, inside the output folder
+JOB_STATES_FILE = "busco_jobs.tsv"
+# states reported by SLURM array tasks and SLURM job files, in a folder next
+# to the output folder (steps 3-6 expect only assembly folders in there)
+JOB_REPORTS_FOLDER = "reports"
+SLURM_FOLDER = "slurm"
 
 def command_parser():
     parser = argparse.ArgumentParser()
@@ -44,9 +73,56 @@ def command_parser():
         one-GCA per line. Only analyze GCAs from inputfolder that appear in \
         this list")
     parser.add_argument("-c", "--cpus", help="Number of cpus to pass to BUSCO\
-        (default: all available)", type=int, default=cpu_count())
+        (default: all available). With --adaptive, total number of cpus shared\
+        by all BUSCO processes", type=int, default=cpu_count())
     parser.add_argument("-p", "--processes", help="Number of BUSCO processes to \
         launch simultaneously. Default: 2", default=2, type=int)
+    parser.add_argument("--scratch", type=Path, help="Folder where genomes are \
+        uncompressed for BUSCO (e.g. a local SSD or /dev/shm). Default: the \
+        system's temporary folder")
+    parser.add_argument("--genome_cache", type=Path, help="Keep uncompressed \
+        genomes in this folder and re-use them in later runs (e.g. when \
+        re-analyzing assemblies). Replaces --scratch")
+    parser.add_argument("--cache_size", type=float, default=100, help="Maximum \
+        size of --genome_cache in GB. The least recently used genomes are \
+        deleted first. Use 0 for no limit. Default: 100")
+    parser.add_argument("--adaptive", action="store_true", default=False, 
+        help="Launch the largest genomes first and give each BUSCO process a \
+        number of cpus according to the genome size (from 1 up to \
+        cpus/processes), without using more than --cpus in total")
+    parser.add_argument("--resume", action="store_true", default=False, 
+        help="Use the job states of the previous run (busco_jobs.tsv in the \
+        output folder): skip finished and failed jobs, and launch interrupted \
+        jobs again")
+    parser.add_argument("--retry_failed", action="store_true", default=False,
+        help="Like --resume, but failed jobs are also launched again")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_METHODS),
+        default="deflate", help="Compression method for the folders with \
+        BUSCO results. Default: deflate")
+    parser.add_argument("--compression_level", type=int, default=6, 
+        help="Compression level (for deflate: 1-9; lower is faster). \
+        Default: 6")
+    parser.add_argument("--compress_threads", type=int, default=2, 
+        help="Number of BUSCO results compressed at the same time, while the \
+        next BUSCO jobs are running. Default: 2")
+    parser.add_argument("--pack", action="store_true", default=False, 
+        help="After compression, pack the whole run folder of each assembly \
+        into a single archive with an index (busco_run.zip), which is faster \
+        to read in the next steps")
+    parser.add_argument("--pack_results", action="store_true", default=False,
+        help="Don't run BUSCO; pack the results already in the output folder \
+        (as with --pack) and exit")
+    parser.add_argument("--executor", choices=["local", "slurm", "slurm-stub"],
+        default="local", help="Where to run BUSCO: 'local' (a pool of \
+        --processes in this computer), 'slurm' (submit a SLURM array job with \
+        sbatch) or 'slurm-stub' (create the SLURM array job but run its tasks \
+        here, one by one; for testing). Default: local")
+    parser.add_argument("--chunk", type=int, default=1, help="With the slurm \
+        executors, number of assemblies analyzed by each array task. \
+        Default: 1")
+    parser.add_argument("--sbatch_options", type=str, default="", help="Extra \
+        options for sbatch, e.g. \"--partition=long --time=2-00:00:00\"")
+    parser.add_argument("--array_jobs", type=Path, help=argparse.SUPPRESS)
     return parser.parse_args()
 
 
@@ -83,31 +159,30 @@ def zipfile_ok(zipfile_path):
         return True
     
     
-def compress_folder(folder, name):
+def compress_folder(folder, name, compression=ZIP_DEFLATED, level=6):
     """
     folder: path
     name: zip file
+    compression, level: zipfile compression method and compresslevel
+    
+    Paths inside the zip file start with the name of 'folder' (e.g. 
+    'hmmer_output/initial_run_results/...')
     """
     
     if not folder.is_dir():
         return
     
+    base = folder.parent
     try:
-        with ZipFile(name, "w", compression=ZIP_DEFLATED, compresslevel=9) as z:
-            for target in folder.glob("**/*"):
-                #print(target)
-                if target.is_dir():
-                    continue
-                
-                # NOTE: the path needs to be relative to the end point of 'folder'
-                # "relative_to" doesn't work...
-                starting_folder = folder.parts[-1] # either 'augustus_output' or 'hmmer_output'
-                target_starting_folder_idx = target.parent.parts.index(starting_folder)
-                target_relative_path = "/".join(target.parent.parts[target_starting_folder_idx:])
-                #print(target_relative_path)
-                arcname_ = "{}/{}".format(target_relative_path, target.name)
-                #print(arcname_)
-                z.write(target, arcname=arcname_)
+        with ZipFile(name, "w", compression=compression, compresslevel=level) as z:
+            # a single walk through the folder; file entries from os.walk
+            # don't need an extra stat to know they're not folders
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                relative_root = Path(root).relative_to(base).as_posix()
+                for filename in sorted(files):
+                    z.write(os.path.join(root, filename), 
+                        arcname="{}/{}".format(relative_root, filename))
     except IOError:
         print("Error! compressing folder {} didn't work...".format(folder))
         return False
@@ -116,69 +191,623 @@ def compress_folder(folder, name):
         return True
         
 
-def busco(cpus, o, gca, db, zipfile, fna_filenames):
-    # in parameters, use "delete=False" to inspect /tmp/*.fna files
-    with tempfile.NamedTemporaryFile(prefix=gca, suffix=".fna") as fasta_file, \
-            ZipFile(zipfile) as gcazip:
-        # read the zipped genome and put it in the temporary file
-        for zipped_fna in fna_filenames:
-            fasta_file.write(gcazip.read(zipped_fna))
-        
-        cmd = []
-        cmd.append("busco")
-        cmd.extend(["--mode", "genome"])
-        cmd.extend(["--cpu", str(cpus)])
-        cmd.extend(["--out_path", str(o)])
-        cmd.extend(["--out", gca])
-        cmd.extend(["--lineage_dataset", str(db.name)])
-        # TODO: choose something else here?
-        cmd.extend(["--augustus_species", "saccharomyces_cerevisiae_S288C"])
-        #cmd.append("--long") # I wonder how bad this can be
-        cmd.extend(["--in", fasta_file.name])
-        print(" ".join(cmd))
+class CpuBudget:
+    """
+    Keeps count of the cpus in use by the running BUSCO processes
+    """
+    def __init__(self, total):
+        self.free = total
+        self.condition = threading.Condition()
+    
+    def acquire(self, n):
+        with self.condition:
+            while self.free < n:
+                self.condition.wait()
+            self.free -= n
+    
+    def release(self, n):
+        with self.condition:
+            self.free += n
+            self.condition.notify_all()
+
+
+def cpus_for_genome(genome_size, largest, max_job_cpus):
+    """
+    Number of cpus for a genome, proportional to its size relative to the
+    largest genome in the set
+    """
+    if largest <= 0:
+        return max_job_cpus
+    return max(1, min(max_job_cpus, math.ceil(max_job_cpus * genome_size / largest)))
+
+
+def stage_genome(zipfile, fna_filenames, target):
+    """
+    Copy the (zipped) genome files into an open binary file, in chunks of 
+    STAGING_BUFFER bytes, so the whole genome is never held in memory
+    """
+    with ZipFile(zipfile) as gcazip:
+        # sorted, to have the same order of sequences in every run
+        for zipped_fna in sorted(fna_filenames):
+            with gcazip.open(zipped_fna) as source:
+                copyfileobj(source, target, STAGING_BUFFER)
+    target.flush()
+
+
+def prune_genome_cache(genome_cache, cache_size, keep):
+    """
+    Delete the least recently used genomes in the cache until it takes at most
+    'cache_size' bytes. Genomes in use (with a .lock file) and 'keep' are 
+    never deleted
+    """
+    genomes = list()
+    total = 0
+    for genome in genome_cache.glob("*.fna"):
+        try:
+            st = genome.stat()
+        except OSError:
+            continue
+        genomes.append((st.st_mtime, st.st_size, genome))
+        total += st.st_size
+    
+    for mtime, size, genome in sorted(genomes):
+        if total <= cache_size:
+            break
+        if genome == keep or genome.with_name(genome.name + ".lock").exists():
+            continue
+        try:
+            genome.unlink()
+        except OSError:
+            continue
+        total -= size
+
+
+def cached_genome(genome_cache, gca, zipfile, fna_filenames, cache_size):
+    """
+    Returns the path of the uncompressed genome in the cache, extracting it
+    first if it's not there (or older than its zip file)
+    """
+    genome = genome_cache / "{}.fna".format(gca)
+    
+    if genome.is_file() and genome.stat().st_mtime >= zipfile.stat().st_mtime:
+        # mark as recently used
+        os.utime(genome)
+        return genome
+    
+    with tempfile.NamedTemporaryFile(prefix=gca, suffix=".part", 
+            dir=genome_cache, delete=False) as partial:
+        try:
+            stage_genome(zipfile, fna_filenames, partial)
+        except (IOError, BadZipFile):
+            os.unlink(partial.name)
+            raise
+    os.replace(partial.name, genome)
+    
+    if cache_size > 0:
+        prune_genome_cache(genome_cache, cache_size, genome)
+    
+    return genome
+
+
+class JobStates:
+    """
+    State of each BUSCO job (queued, running, done or failed), with its wall 
+    time, peak memory and exit code. Saved in the output folder each time a 
+    job changes state, so it can be used to resume an interrupted run.
+    
+    Jobs running elsewhere (SLURM array tasks) can't share the file, so they 
+    report their state in a small file per assembly instead (report_state). 
+    These files are merged (and deleted) the next time the states are saved
+    """
+    header = "Assembly\tState\tWall time (s)\tPeak RSS (MB)\tExit code\n"
+    
+    def __init__(self, folder):
+        self.path = folder / JOB_STATES_FILE
+        self.reports = jobs_folder(folder) / JOB_REPORTS_FOLDER
+        self.states = dict() # key: gca. value: [state, wall time, peak rss, exit code]
+        self.merged = dict() # key: report file. value: its mtime when merged
+        self.lock = threading.Lock()
+        
+        if self.path.is_file():
+            self.read(self.path)
+        
+        if self.reports.is_dir():
+            for report in self.reports.glob("*.tsv"):
+                try:
+                    self.merged[report] = report.stat().st_mtime_ns
+                    self.read(report)
+                except (IOError, IndexError):
+                    continue
+    
+    def read(self, path):
+        with open(path) as f:
+            for line in f:
+                if line.startswith("Assembly") or line.strip() == "":
+                    continue
+                x = line.rstrip("\n").split("\t")
+                self.states[x[0]] = x[1:5]
+    
+    def get(self, gca):
+        return self.states.get(gca, [""])[0]
+    
+    def set(self, gca, state, wall_time="", peak_rss="", exit_code="", save=True):
+        with self.lock:
+            # "running" comes from a different thread than "done"/"failed" 
+            # and may arrive after them for jobs that end quickly
+            if state == "running" and self.get(gca) not in ("", "queued"):
+                return
+            self.states[gca] = [state, str(wall_time), str(peak_rss), str(exit_code)]
+            if save:
+                self.save()
+    
+    def job_done(self, result):
+        self.set(*result_state(result))
+    
+    def save(self):
+        # write to a temporary file first to avoid a truncated state file
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(self.header)
+            for gca in sorted(self.states):
+                f.write("{}\t{}\n".format(gca, "\t".join(self.states[gca])))
+        os.replace(tmp_path, self.path)
         
+        # reports are now in the main file (unless they changed after reading)
+        for report, mtime in self.merged.items():
+            try:
+                if report.stat().st_mtime_ns == mtime:
+                    report.unlink()
+            except OSError:
+                continue
+        self.merged = dict()
+
+
+def jobs_folder(o):
+    """
+    e.g. 'Busco_results_jobs' for 'Busco_results'
+    """
+    return o.parent / "{}_jobs".format(o.name)
+
+
+def report_state(o, gca, state, wall_time="", peak_rss="", exit_code=""):
+    """
+    Writes the state of one job in its own file (see JobStates)
+    """
+    reports = jobs_folder(o) / JOB_REPORTS_FOLDER
+    os.makedirs(reports, exist_ok=True)
+    tmp_path = reports / "{}.tsv.tmp".format(gca)
+    with open(tmp_path, "w") as f:
+        f.write("{}\t{}\t{}\t{}\t{}\n".format(gca, state, wall_time, 
+            peak_rss, exit_code))
+    os.replace(tmp_path, reports / "{}.tsv".format(gca))
+
+
+def result_state(result):
+    """
+    Converts the result of busco() to a (gca, state, wall time, peak rss, 
+    exit code) tuple
+    """
+    gca, ok, exit_code, wall_time, peak_rss = result
+    state = "done" if ok else "failed"
+    if exit_code is None:
+        exit_code = ""
+    return gca, state, wall_time, "{:.0f}".format(peak_rss), exit_code
+
+
+def listen_running(events, states):
+    """
+    Marks jobs as running when a worker starts them (until it gets None)
+    """
+    for gca in iter(events.get, None):
+        states.set(gca, "running")
+
+
+def busco(cpus, o, gca, db, zipfile, fna_filenames, scratch=None, 
+        genome_cache=None, cache_size=0, force=False, events=None):
+    """
+    Stages the genome (in 'scratch' or in the persistent 'genome_cache'), 
+    runs BUSCO on it and compresses the results.
+    Returns a tuple (gca, ok, exit code, wall time, peak RSS in MB)
+    """
+    if events is not None:
+        events.put(gca)
+    start = time.time()
+    
+    if genome_cache:
+        lock = genome_cache / "{}.fna.lock".format(gca)
+        lock.touch()
         try:
-            proc = subprocess.run(cmd, stderr=STDOUT, encoding="utf-8")
-        except FileNotFoundError as e:
-            print("Error running busco command:")
-            print(e)
-            return False
-        else:
-            base_target_folder = o / gca / "run_ascomycota_odb10"
-            
-            augustus_folder = base_target_folder / "augustus_output/"
-            hmmer_output_folder = base_target_folder / "hmmer_output/"
-            busco_seq_folder = base_target_folder / "busco_sequences"
-            
-            augustus_zip = base_target_folder / "augustus_output.zip"
-            hmmer_output_zip = base_target_folder / "hmmer_output.zip"
-            busco_seq_zip = base_target_folder / "busco_sequences.zip"
+            fasta_path = cached_genome(genome_cache, gca, zipfile, 
+                fna_filenames, cache_size)
+            exit_code, peak_rss = run_busco(cpus, o, gca, db, fasta_path, force)
+        finally:
+            lock.unlink()
+    else:
+        # in parameters, use "delete=False" to inspect /tmp/*.fna files
+        with tempfile.NamedTemporaryFile(prefix=gca, suffix=".fna", 
+                dir=scratch) as fasta_file:
+            # read the zipped genome and put it in the temporary file
+            stage_genome(zipfile, fna_filenames, fasta_file)
+            exit_code, peak_rss = run_busco(cpus, o, gca, db, 
+                Path(fasta_file.name), force)
+    
+    ok = exit_code == 0
+    return (gca, ok, exit_code, round(time.time() - start), peak_rss)
+
+
+def finish_job(result, o, compression):
+    """
+    Compresses the results of a finished busco() job. Runs in a thread (see
+    Compressor), so it overlaps with the next BUSCO run.
+    Returns the result, now failed if the compression didn't work
+    """
+    gca, ok, exit_code, wall_time, peak_rss = result
+    codec, level, threads, pack = compression
+    
+    if exit_code is not None:
+        compressed = compress_results(o, gca, COMPRESSION_METHODS[codec], level)
+        ok = ok and compressed
+        if ok and pack:
+            ok = pack_results(o / gca, COMPRESSION_METHODS[codec], level)
+    
+    return (gca, ok, exit_code, wall_time, peak_rss)
+
+
+def pack_results(assembly_folder, compression=ZIP_DEFLATED, level=6):
+    """
+    Packs the run folder of an assembly into a single archive with an index
+    (see busco_archive). The run folder is deleted if the archive is ok
+    """
+    run_folders = [f for f in assembly_folder.glob("run_*") if f.is_dir()]
+    if len(run_folders) != 1:
+        print("Error: can't find the run folder of {}".format(assembly_folder))
+        return False
+    
+    archive = assembly_folder / ARCHIVE_NAME
+    print("\tPacking {}".format(run_folders[0]))
+    try:
+        pack_run(run_folders[0], archive, compression, level)
+        with BuscoArchive(archive) as a:
+            if "short_summary.txt" not in a.members:
+                raise BadZipFile("short_summary.txt is missing")
+    except (IOError, BadZipFile) as e:
+        print("Error packing {} ({})".format(run_folders[0], e))
+        if archive.is_file():
+            archive.unlink()
+        return False
+    
+    rmtree(run_folders[0])
+    return True
+
+
+class Compressor:
+    """
+    Thread pool for the compression of BUSCO results. zlib (and the other 
+    compressors) release the GIL, so several folders can be compressed at the
+    same time while the next BUSCO jobs run
+    """
+    def __init__(self, o, compression):
+        self.o = o
+        self.compression = compression
+        self.executor = ThreadPoolExecutor(max_workers=max(1, compression[2]))
+        self.futures = list()
+    
+    def submit(self, result, done):
+        """
+        Compresses the results in the background and calls done() with the
+        final result
+        """
+        def task():
+            try:
+                final = finish_job(result, self.o, self.compression)
+            except Exception as e:
+                print("Error compressing results of {} ({})".format(result[0], e))
+                final = (result[0], False) + tuple(result[2:])
+            done(final)
+        self.futures.append(self.executor.submit(task))
+    
+    def wait(self):
+        """
+        Waits until the results submitted so far are compressed
+        """
+        wait(self.futures)
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def run_busco(cpus, o, gca, db, fasta_path, force=False):
+    """
+    Returns BUSCO's exit code (None if it couldn't be launched) and its peak 
+    memory use in MB
+    """
+    cmd = []
+    cmd.append("busco")
+    cmd.extend(["--mode", "genome"])
+    cmd.extend(["--cpu", str(cpus)])
+    cmd.extend(["--out_path", str(o)])
+    cmd.extend(["--out", gca])
+    cmd.extend(["--lineage_dataset", str(db.name)])
+    # TODO: choose something else here?
+    cmd.extend(["--augustus_species", "saccharomyces_cerevisiae_S288C"])
+    #cmd.append("--long") # I wonder how bad this can be
+    cmd.extend(["--in", str(fasta_path)])
+    # overwrite the results of an interrupted/failed run
+    if force:
+        cmd.append("--force")
+    print(" ".join(cmd))
+    
+    try:
+        proc = subprocess.Popen(cmd, stderr=STDOUT, encoding="utf-8")
+    except FileNotFoundError as e:
+        print("Error running busco command:")
+        print(e)
+        return None, 0
+    
+    # unlike proc.wait(), wait4 also returns the resources used by BUSCO
+    # (ru_maxrss is in KB)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # same as os.waitstatus_to_exitcode (Python 3.9+)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if proc.returncode != 0:
+        print("Error: BUSCO exited with code {} for {}".format(proc.returncode, gca))
+    return proc.returncode, rusage.ru_maxrss / 1024
+
+
+def compress_results(o, gca, compression=ZIP_DEFLATED, level=6):
+    """
+    Compresses the folders with many small files of a BUSCO run.
+    Returns True if all zip files are ok
+    """
+    ok = True
+    base_target_folder = o / gca / "run_ascomycota_odb10"
+    
+    augustus_folder = base_target_folder / "augustus_output/"
+    hmmer_output_folder = base_target_folder / "hmmer_output/"
+    busco_seq_folder = base_target_folder / "busco_sequences"
+    
+    augustus_zip = base_target_folder / "augustus_output.zip"
+    hmmer_output_zip = base_target_folder / "hmmer_output.zip"
+    busco_seq_zip = base_target_folder / "busco_sequences.zip"
+    
+    # Augustus
+    # Check first as BUSCO 5 doesn't necessarily use Augustus
+    if augustus_folder.is_dir():
+        print("\tCompressing augustus output")
+        compress_folder(augustus_folder, augustus_zip, compression, level)
+        # check if it worked
+        if not zipfile_ok(augustus_zip):
+            print("Error zipping file {}".format(augustus_zip))
+            ok = False
+        
+    # hmmer
+    print("\tCompressing hmmer output")
+    compress_folder(hmmer_output_folder, hmmer_output_zip, compression, level)
+    # check if it worked
+    if not zipfile_ok(hmmer_output_zip):
+        print("Error zipping file {}".format(hmmer_output_zip))
+        ok = False
+        
+    # busco_sequences
+    print("\tCompressing busco_seq output")
+    compress_folder(busco_seq_folder, busco_seq_zip, compression, level)
+    if not zipfile_ok(busco_seq_zip):
+        print("Error zipping file {}".format(busco_seq_zip))
+        ok = False
+        
+    return ok
+
+
+class LocalExecutor:
+    """
+    Runs the BUSCO jobs in a multiprocessing Pool in this computer
+    """
+    def __init__(self, cpus, processes, adaptive):
+        self.cpus = cpus
+        self.processes = processes
+        self.adaptive = adaptive
+    
+    def run(self, jobs, busco_settings, states):
+        """
+        Returns True when all jobs are finished
+        """
+        o, db, scratch, genome_cache, cache_size, compression = busco_settings
+        
+        def job_failed(e, gca):
+            print("Error: job for {} failed ({})".format(gca, e))
+            states.set(gca, "failed")
+        
+        # BUSCO results are compressed in the background, after each job
+        compressor = Compressor(o, compression)
+        
+        with Manager() as manager:
+            # workers report here when they start a job
+            events = manager.Queue()
+            listener = threading.Thread(target=listen_running, args=(events, states))
+            listener.start()
             
-            # Augustus
-            # Check first as BUSCO 5 doesn't necessarily use Augustus
-            if augustus_folder.is_dir():
-                print("\tCompressing augustus output")
-                compress_folder(augustus_folder, augustus_zip)
-                # check if it worked
-                if not zipfile_ok(augustus_zip):
-                    print("Error zipping file {}".format(augustus_zip))
+            if not self.adaptive:
+                with Pool(processes=self.processes) as pool:
+                    for genome_size, gca, zipfile, fna_filenames, force in jobs:
+                        # Opening the zip here and passing it to apply_sync doesn't work.
+                        # Someone on stackoverflow (questions/37907350) suggests that
+                        # all parameters need to be pickle-able...
+                        # so passing the zipfile location and opening on each children
+                        # process actually does the trick
+                        pool.apply_async(busco, args=(self.cpus, o, gca, db, zipfile, 
+                            fna_filenames, scratch, genome_cache, cache_size, 
+                            force, events, ), 
+                            callback=lambda result: compressor.submit(result, 
+                                states.job_done), 
+                            error_callback=lambda e, gca=gca: job_failed(e, gca))
+                        
+                    pool.close()
+                    pool.join()
+            else:
+                # largest genomes first, so they don't end up as stragglers. Each job
+                # takes its cpus from the budget and gives them back when it's done
+                jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+                largest = jobs[0][0] if jobs else 0
+                max_job_cpus = max(1, self.cpus // self.processes)
+                budget = CpuBudget(self.cpus)
                 
-            # hmmer
-            print("\tCompressing hmmer output")
-            compress_folder(hmmer_output_folder, hmmer_output_zip)
-            # check if it worked
-            if not zipfile_ok(hmmer_output_zip):
-                print("Error zipping file {}".format(hmmer_output_zip))
+                # when BUSCO finishes, its cpus are free except one, which is
+                # kept until its results are compressed
+                def finished(result, n):
+                    budget.release(n - 1)
+                    def compressed(final):
+                        budget.release(1)
+                        states.job_done(final)
+                    compressor.submit(result, compressed)
                 
-            # busco_sequences
-            print("\tCompressing busco_seq output")
-            compress_folder(busco_seq_folder, busco_seq_zip)
-            if not zipfile_ok(busco_seq_zip):
-                print("Error zipping file {}".format(busco_seq_zip))
+                def crashed(e, gca, n):
+                    budget.release(n)
+                    job_failed(e, gca)
                 
+                with Pool(processes=self.cpus) as pool:
+                    for genome_size, gca, zipfile, fna_filenames, force in jobs:
+                        job_cpus = cpus_for_genome(genome_size, largest, max_job_cpus)
+                        budget.acquire(job_cpus)
+                        print("{}: {:.1f} Mb, {} cpus".format(gca, genome_size/1e6, job_cpus))
+                        pool.apply_async(busco, args=(job_cpus, o, gca, db, zipfile, 
+                            fna_filenames, scratch, genome_cache, cache_size, force, 
+                            events, ), 
+                            callback=lambda result, n=job_cpus: finished(result, n), 
+                            error_callback=lambda e, gca=gca, n=job_cpus: crashed(e, gca, n))
+                    
+                    pool.close()
+                    pool.join()
+            
+            compressor.shutdown()
+            events.put(None)
+            listener.join()
+        
+        return True
+
+
+class SlurmExecutor:
+    """
+    Runs the BUSCO jobs as a SLURM array job. Each array task calls this 
+    script again (with --array_jobs) to analyze 'chunk' assemblies, using the
+    same busco() function (staging, BUSCO and compression) as the local 
+    executor.
+    'submit' is called with the path to the sbatch script and the number of
+    tasks; it returns True if the tasks are already finished
+    """
+    def __init__(self, cpus, chunk, sbatch_options, submit):
+        self.cpus = cpus
+        self.chunk = max(1, chunk)
+        self.sbatch_options = sbatch_options
+        self.submit = submit
+    
+    def run(self, jobs, busco_settings, states):
+        o, db, scratch, genome_cache, cache_size, compression = busco_settings
+        if not jobs:
             return True
+        
+        slurm_folder = jobs_folder(o) / SLURM_FOLDER
+        os.makedirs(slurm_folder, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S")
+        
+        # one line per job. Array task n reads lines [n*chunk, (n+1)*chunk)
+        job_file = slurm_folder / "jobs_{}.tsv".format(name)
+        with open(job_file, "w") as f:
+            for genome_size, gca, zipfile, fna_filenames, force in jobs:
+                f.write("{}\t{}\t{}\t{}\n".format(gca, zipfile.resolve(), 
+                    int(force), ",".join(sorted(fna_filenames))))
+        tasks = math.ceil(len(jobs) / self.chunk)
+        
+        cmd = [sys.executable, str(Path(__file__).resolve())]
+        cmd.extend(["--inputfolder", str(zipfile.parent.resolve())])
+        cmd.extend(["--outputfolder", str(o)])
+        cmd.extend(["--dbfolder", str(db)])
+        cmd.extend(["--cpus", str(self.cpus)])
+        if scratch:
+            cmd.extend(["--scratch", str(scratch)])
+        if genome_cache:
+            cmd.extend(["--genome_cache", str(genome_cache)])
+            cmd.extend(["--cache_size", str(cache_size / 1024**3)])
+        codec, level, threads, pack = compression
+        cmd.extend(["--compression", codec])
+        cmd.extend(["--compression_level", str(level)])
+        cmd.extend(["--compress_threads", str(threads)])
+        if pack:
+            cmd.append("--pack")
+        cmd.extend(["--chunk", str(self.chunk)])
+        cmd.extend(["--array_jobs", str(job_file.resolve())])
+        
+        script = slurm_folder / "busco_array_{}.sh".format(name)
+        with open(script, "w") as f:
+            f.write("#!/bin/bash\n")
+            f.write("#SBATCH --job-name=busco\n")
+            f.write("#SBATCH --array=0-{}\n".format(tasks - 1))
+            f.write("#SBATCH --cpus-per-task={}\n".format(self.cpus))
+            f.write("#SBATCH --output={}/busco_%A_%a.log\n".format(slurm_folder.resolve()))
+            f.write("\n")
+            # BUSCO gets relative paths; run from the same folder as this script
+            f.write("cd {}\n".format(shlex.quote(os.getcwd())))
+            f.write("{}\n".format(" ".join(shlex.quote(c) for c in cmd)))
+        
+        print("Array job with {} tasks for {} assemblies: {}".format(tasks, 
+            len(jobs), script))
+        return self.submit(script, tasks, self.sbatch_options)
 
 
+def submit_sbatch(script, tasks, sbatch_options):
+    cmd = ["sbatch"] + shlex.split(sbatch_options) + [str(script)]
+    print(" ".join(cmd))
+    subprocess.run(cmd, check=True)
+    return False
+
+
+def submit_stub(script, tasks, sbatch_options):
+    """
+    Runs the tasks of the array job here, one after the other
+    """
+    for task in range(tasks):
+        env = dict(os.environ)
+        env["SLURM_ARRAY_TASK_ID"] = str(task)
+        subprocess.run(["bash", str(script)], env=env)
+    return True
+
+
+def run_array_task(job_file, chunk, cpus, busco_settings):
+    """
+    Runs the jobs of one SLURM array task (SLURM_ARRAY_TASK_ID)
+    """
+    o, db, scratch, genome_cache, cache_size, compression = busco_settings
+    task = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    
+    with open(job_file) as f:
+        lines = f.readlines()[task*chunk:(task+1)*chunk]
+    
+    # The results of an assembly are compressed while BUSCO runs on the next
+    # one, so these BUSCO runs leave cpus for the compression threads (with a
+    # single cpu, results are compressed before the next BUSCO run)
+    codec, level, threads, pack = compression
+    reserved = min(max(1, threads), cpus - 1)
+    compressor = Compressor(o, (codec, level, max(1, reserved), pack))
+    done = lambda final: report_state(o, *result_state(final))
+    for n, line in enumerate(lines):
+        gca, zipfile, force, fna_filenames = line.rstrip("\n").split("\t")
+        if reserved == 0:
+            compressor.wait()
+        job_cpus = cpus if n == 0 else cpus - reserved
+        report_state(o, gca, "running")
+        try:
+            result = busco(job_cpus, o, gca, db, Path(zipfile), 
+                set(fna_filenames.split(",")), scratch, genome_cache, 
+                cache_size, force == "1")
+        except Exception as e:
+            print("Error: job for {} failed ({})".format(gca, e))
+            report_state(o, gca, "failed")
+        else:
+            compressor.submit(result, done)
+    compressor.shutdown()
+
 if __name__ == "__main__":
     options = command_parser()
     
@@ -194,6 +823,34 @@ if __name__ == "__main__":
     if not db.is_dir():
         sys.exit("Error (--dbfolder). {} does not seem a valid folder".format(db))
     re_analyze_gca = read_re_analyze(options.re_analyze_file)
+    scratch = options.scratch
+    if scratch and not scratch.is_dir():
+        os.makedirs(scratch, exist_ok=True)
+    genome_cache = options.genome_cache
+    if genome_cache and not genome_cache.is_dir():
+        os.makedirs(genome_cache, exist_ok=True)
+    cache_size = int(options.cache_size * 1024**3)
+    compression = (options.compression, options.compression_level, 
+        options.compress_threads, options.pack)
+    
+    # post-processing of existing results only
+    if options.pack_results:
+        folders = sorted(f for f in o.glob("*") if f.is_dir() and not 
+            (f / ARCHIVE_NAME).is_file())
+        print("Packing results of {} assemblies".format(len(folders)))
+        with ThreadPoolExecutor(max_workers=max(1, options.compress_threads)) as executor:
+            packed = executor.map(lambda f: pack_results(f, 
+                COMPRESSION_METHODS[options.compression], 
+                options.compression_level), folders)
+            failed = [f.name for f, ok in zip(folders, packed) if not ok]
+        print("Done ({} failed)".format(len(failed)))
+        sys.exit()
+    
+    # this is one task of a SLURM array job
+    if options.array_jobs:
+        run_array_task(options.array_jobs, options.chunk, cpus, (o, db, 
+            scratch, genome_cache, cache_size, compression))
+        sys.exit()
     
     gca_filter = set()
     if options.filter_list:
@@ -202,54 +859,90 @@ if __name__ == "__main__":
                 if line.strip() == "":
                     continue
                 else:
-                    gca_filter.add(line.strip)
+                    gca_filter.add(line.strip())
+    
+    # zip files already checked in step 1 (or in previous runs) are not 
+    # opened again unless they changed
+    manifest = ZipManifest(i)
+    
+    # state of the jobs of this and previous runs
+    states = JobStates(o)
     
     # traverse zip files
-    with Pool(processes=options.processes) as pool:
-        for zipfile in i.glob("*.zip"):
-            gca = zipfile.stem
-            
-            # only calculate new stuff
-            if re_analyze_gca:
-                if gca not in re_analyze_gca:
-                    continue
-            
-            if gca_filter:
-                if gca not in gca_filter:
-                    continue
-            
-            # Check if results folder exist already and we don't need to re-analyze
-            if (o / gca).is_dir():
-                # if no re-analyze file is given, this set is empty
-                if gca not in re_analyze_gca:
-                    continue
+    jobs = list() # (genome size, gca, zipfile, fna_filenames, force)
+    for zipfile in i.glob("*.zip"):
+        gca = zipfile.stem
         
-            try:
-                with ZipFile(zipfile) as gcazip:
-                    fna_filenames = set()
-                    # traverse all names inside the zip. Genome may be split into
-                    # more than one (chromosome-level) file
-                    for item in gcazip.namelist():
-                        if item.startswith("ncbi_dataset/data/"+gca) and item[-3:] == "fna":
-                            fna_filenames.add(item)
-                
-                    if not fna_filenames:
-                        print("Warning: could not find any .fna file for {}".format(gca))
-                        continue
-                    
-                    # This doesn't work with apply_sync because of gcazip. 
-                    # Someone on stackoverflow (questions/37907350) suggests that
-                    # all parameters need to be pickle-able...
-                    #busco(cpus, o, gca, db, gcazip, fna_filename, )
-                    
-                # so passing the zipfile location and opening on each children
-                # process actually does the trick
-                pool.apply_async(busco, args=(cpus, o, gca, db, zipfile, fna_filenames, ))
-                    
-            except BadZipFile:
-                print("Warning: Cannot open {}".format(zipfile))
+        # only calculate new stuff
+        if re_analyze_gca:
+            if gca not in re_analyze_gca:
                 continue
-            
-        pool.close()
-        pool.join()
-            
+        
+        if gca_filter:
+            if gca not in gca_filter:
+                continue
+        
+        # use the states of the previous run: skip finished jobs and re-launch
+        # interrupted ones (and failed ones, if requested)
+        resume = False
+        if options.resume or options.retry_failed:
+            state = states.get(gca)
+            if state == "done":
+                continue
+            if state == "failed" and not options.retry_failed:
+                continue
+            resume = state != ""
+        
+        # Check if results folder exist already and we don't need to re-analyze
+        force = False
+        if (o / gca).is_dir():
+            # if no re-analyze file is given, this set is empty
+            if gca not in re_analyze_gca and not resume:
+                continue
+            force = True
+    
+        members = manifest.check(zipfile)
+        if members is None:
+            print("Warning: Cannot open {}".format(zipfile))
+            continue
+        
+        fna_filenames = set()
+        # traverse all names inside the zip. Genome may be split into
+        # more than one (chromosome-level) file
+        for item in members:
+            if item.startswith("ncbi_dataset/data/"+gca) and item[-3:] == "fna":
+                fna_filenames.add(item)
+    
+        if not fna_filenames:
+            print("Warning: could not find any .fna file for {}".format(gca))
+            continue
+        
+        jobs.append((manifest.genome_size(zipfile), gca, zipfile, fna_filenames, force))
+        states.set(gca, "queued", save=False)
+    
+    manifest.save()
+    states.save()
+    
+    busco_settings = (o, db, scratch, genome_cache, cache_size, compression)
+    if options.executor == "local":
+        executor = LocalExecutor(cpus, options.processes, options.adaptive)
+    else:
+        if options.adaptive:
+            print("Warning: --adaptive is not used with the slurm executors")
+        submit = submit_sbatch if options.executor == "slurm" else submit_stub
+        executor = SlurmExecutor(cpus, options.chunk, options.sbatch_options, 
+            submit)
+    
+    if not executor.run(jobs, busco_settings, states):
+        # jobs will finish later, the states file will be updated then
+        sys.exit()
+    
+    # merge the states reported by array tasks, if any
+    states = JobStates(o)
+    states.save()
+    
+    failed = sorted(job[1] for job in jobs if states.get(job[1]) != "done")
+    print("Finished {} jobs ({} failed). See {}".format(len(jobs), len(failed), 
+        states.path))
+    for gca in failed:
+        print("\tFailed: {}".format(gca))
@@ -13,7 +13,10 @@ import os
 import argparse
 from pathlib import Path
 #import zipfile as zip
-from zipfile import ZipFile, BadZipFile
+from zipfile import BadZipFile
+from concurrent.futures import ThreadPoolExecutor
+from busco_results import BuscoResult
+from busco_catalog import BuscoCatalog
 
 def arg_parser():
     parser = argparse.ArgumentParser()
@@ -23,6 +26,12 @@ def arg_parser():
         first column is the assembly name, third column is the species name, and\
         fourth column is the strain name. Will be used to annotate summary file \
         (Optional).", type=Path)
+    parser.add_argument("-t", "--threads", help="Number of assemblies read at \
+        the same time. Use 1 to read them one by one. Default: 8", type=int,
+        default=8)
+    parser.add_argument("-c", "--catalog", help="Catalog of BUSCO results \
+        (created if it doesn't exist). Only new or changed results will be read \
+        (Optional).", type=Path)
     return parser.parse_args()
 
 
@@ -57,6 +66,52 @@ def read_metadata_file(filepath):
     else:
         return name_dictionary
 
+def harvest_assembly(folder):
+    """
+    Reads the results of one assembly.
+    Returns a tuple with the assembly name, the list of [C, S, D, F, M] 
+    numbers (None if the summary is missing), the discrepancy between reported
+    and found single copy BUSCOs (None if there is none) and the messages to
+    print
+    """
+    assembly = folder.parts[-1]
+    try:
+        result = BuscoResult(folder)
+    except FileNotFoundError:
+        sys.exit("Error: Can't find the run folder of assembly {}".format(assembly))
+    return check_result(result)
+
+
+def check_result(result):
+    """
+    Same as harvest_assembly(), for a result that has already been read
+    """
+    assembly = result.assembly
+    messages = [str(result.location)]
+    
+    if result.reported is None:
+        messages.append("Warning: Can't find summary file for assembly {}".format(assembly))
+        return assembly, None, None, messages
+    C, S, D, F, M = result.reported
+    
+    # place with fasta files
+    try:
+        fnas, faas, others = result.single_copy_counts()
+    except (FileNotFoundError, BadZipFile):
+        sys.exit("Error: Can't find results for assembly {}".format(assembly))
+    for x in others:
+        messages.append("Unknown type {}".format(x))
+        
+    #if len(fnas) != len(faas):
+        #print("Warning! BUSCO results for {} have different number of fna and faa files ({}, {})".format(assembly, len(fnas), len(faas)))
+        
+    # Detect discrepancy between reported number of complete and single-copy hits vs actual files
+    discrepancy = None
+    if faas != S:
+        discrepancy = (S, fnas)
+    return assembly, [C, S, D, F, M], discrepancy, messages
+
+
 if __name__ == "__main__":
     args = arg_parser()
     
@@ -69,82 +124,37 @@ if __name__ == "__main__":
     # Create a pandas data frame to store all the single copy busco hits
     discrepancies = dict() # key: assembly. value: tuple of reported complete+single BUSCOs (S), number of files
     summary = dict() # value: a list of [C, S, D, F, M] BUSCO results
-    for num, folder in enumerate(sorted(i.glob("*"))):
-        # only traverse folders
-        if not folder.is_dir():
-            continue
-        
-        assembly = folder.parts[-1]
-
-        for runfolder in folder.glob("*"):
-            if not runfolder.is_dir():
-                continue
-            if not runfolder.parts[-1].startswith("run_"):
-                continue
-            else:
-                break
-        assert(runfolder.parts[-1].startswith("run_"))
-        print(runfolder)
-        
-        # place with summary
-        summary_file = None
-        for item in runfolder.glob("*"):
-            # print(item.name)
-            if item.name == "short_summary.txt":
-                summary_file = item
-                break
-
-        if summary_file is None:
-            print("Warning: Can't find summary file for assembly {}".format(assembly))
+    folders = sorted(i.glob("*"))
+    num = len(folders) - 1
+    
+    # only traverse folders
+    folders = [folder for folder in folders if folder.is_dir()]
+    if args.catalog:
+        # only new or changed results are read again
+        with BuscoCatalog(args.catalog) as catalog:
+            catalog.update(i, args.threads)
+            catalog_results = catalog.results(i)
+        # assemblies without results are not in the catalog; stop as when
+        # reading the folders
+        for folder in folders:
+            if folder.name not in catalog_results:
+                sys.exit("Error: Can't find the run folder of assembly {}".format(folder.name))
+        results = [check_result(result) for result in catalog_results.values()]
+    elif args.threads > 1:
+        # results come back in the same (sorted) order as the folders
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            results = list(executor.map(harvest_assembly, folders))
+    else:
+        results = [harvest_assembly(folder) for folder in folders]
+    
+    for assembly, numbers, discrepancy, messages in results:
+        for message in messages:
+            print(message)
+        if numbers is None:
             continue
-        with open(summary_file) as f:
-            lines = f.readlines()
-            # NOTE: In BUSCO 4, line with "Complete BUSCOs" is 9, but for
-            # BUSCO 5, it's line 10!
-            for n, l in enumerate(lines):
-                if l.strip().endswith("Complete BUSCOs (C)"):
-                    C = int(l.strip().split("\t")[0])
-                    break
-            S = int(lines[n+1].strip().split("\t")[0])
-            D = int(lines[n+2].strip().split("\t")[0])
-            F = int(lines[n+3].strip().split("\t")[0])
-            M = int(lines[n+4].strip().split("\t")[0])
-            
-            summary[assembly] = [C, S, D, F, M]
-        
-        # place with fasta files
-        target_folder = runfolder / "busco_sequences/single_copy_busco_sequences/"
-        if not target_folder.is_dir():
-            # try to see if results where zipped            
-            try:
-                target_zip = runfolder / "busco_sequences.zip"
-                fnas = set()
-                faas = set()
-                with ZipFile(target_zip) as z:
-                    for x in z.namelist():
-                        if x.startswith("busco_sequences/single_copy_busco_sequences/"):
-                            if x[-3:] == "fna":
-                                fnas.add(x)
-                            elif x[-3:] == "faa":
-                                faas.add(x)
-                            else:
-                                print("Unknown type {}".format(x))
-                #sys.exit()
-                    
-            except:
-                sys.exit("Error: Can't find results for assembly {}".format(target_folder))
-                
-        else:
-            fnas = set([fasta_file.stem for fasta_file in target_folder.glob("*.fna")])
-            faas = set([fasta_file.stem for fasta_file in target_folder.glob("*.faa")])
-            
-        #if len(fnas) != len(faas):
-            #print("Warning! BUSCO results for {} have different number of fna and faa files ({}, {})".format(assembly, len(fnas), len(faas)))
-            
-        # Detect discrepancy between reported number of complete and single-copy hits vs actual files
-        if len(faas) != S:
-            discrepancies[assembly] = (S, len(fnas))
-            
+        summary[assembly] = numbers
+        if discrepancy is not None:
+            discrepancies[assembly] = discrepancy
     
     
     # Finalize. 
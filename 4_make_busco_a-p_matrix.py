@@ -9,8 +9,11 @@ import sys
 import os
 import argparse
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from zipfile import ZipFile
+from busco_results import BuscoResult
+from busco_catalog import BuscoCatalog
+from busco_matrix import save_matrix
 
 def arg_parser():
     parser = argparse.ArgumentParser()
@@ -19,8 +22,36 @@ def arg_parser():
     parser.add_argument("-f", "--filter_list", help="Optional. File with list \
         of assemblies. Only the assemblies from the input folder that are in \
         this list will be processed (it can be a tab-separated file)", type=Path)
+    parser.add_argument("-c", "--catalog", help="Optional. Catalog of BUSCO \
+        results (created if it doesn't exist). Only new or changed results will \
+        be read", type=Path)
+    parser.add_argument("--format", help="Format of the matrix: 'tsv' \
+        (busco_a-p_matrix.tsv), 'binary' (busco_a-p_matrix.bin, bit-packed, \
+        faster to read in step 5) or 'both'. Default: tsv", 
+        choices=["tsv", "binary", "both"], default="tsv")
     return parser.parse_args()
 
+def make_matrix(data, all_busco_hits):
+    """
+    Returns the a/p matrix as a boolean dataframe (rows: assemblies, sorted; 
+    columns: BUSCOs, sorted).
+    data: assembly -> set of BUSCO hits
+    """
+    assemblies = sorted(data.keys())
+    buscos = sorted(all_busco_hits)
+    column = {busco: n for n, busco in enumerate(buscos)}
+    
+    # row and column of every hit, set all at once
+    hits = [len(data[assembly]) for assembly in assemblies]
+    rows = np.repeat(np.arange(len(assemblies)), hits)
+    columns = np.fromiter((column[hit] for assembly in assemblies for hit in 
+        data[assembly]), dtype=np.intp, count=sum(hits))
+    matrix = np.zeros((len(assemblies), len(buscos)), dtype=bool)
+    matrix[rows, columns] = True
+    
+    return pd.DataFrame(matrix, index=assemblies, columns=buscos)
+
+
 if __name__ == "__main__":
     args = arg_parser()
     
@@ -38,6 +69,13 @@ if __name__ == "__main__":
         except IOError:
             sys.exit("Error: --filter_list used, but cannot open file")
     
+    # only new or changed results are read again
+    catalog_results = None
+    if args.catalog:
+        with BuscoCatalog(args.catalog) as catalog:
+            catalog.update(i)
+            catalog_results = catalog.results(i, filter_list if filter_list else None)
+    
     # Create a pandas data frame to store all the single copy busco hits
     all_busco_hits = set()
     data = dict()
@@ -52,48 +90,33 @@ if __name__ == "__main__":
             if assembly not in filter_list:
                 continue
         
-        # place with fasta files
-        rfs = list(folder.glob("run_*"))
-        assert(len(rfs) == 1)
-        run_folder = rfs[0]
-
-        target_folder = run_folder / "busco_sequences/single_copy_busco_sequences/"
-        
-        if not target_folder.is_dir():
-            # try to see if results have been zipped
-            try:
-                scbs_set = set()
-                target_zip = folder / "run_ascomycota_odb10/busco_sequences.zip"
-                with ZipFile(target_zip) as z:
-                    for x in z.namelist():
-                        xpath = Path(x)
-                        # only get complete single_copy_busco_sequences
-                        if len(xpath.parts) < 2:
-                            continue
-                        if xpath.parts[1] != "single_copy_busco_sequences":
-                            continue
-                        if xpath.suffix == ".fna":
-                            scbs_set.add(xpath.stem)
-            except:
-                sys.exit("Error with zip file {}".format(target_zip))
+        if catalog_results is not None:
+            result = catalog_results.get(assembly)
+            if result is None:
+                sys.exit("Error: Can't find the run folder of assembly {}".format(assembly))
         else:
-            scbs_set = set([fasta_file.stem for fasta_file in target_folder.glob("*.faa")])
+            try:
+                result = BuscoResult(folder)
+            except FileNotFoundError:
+                sys.exit("Error: Can't find the run folder of assembly {}".format(assembly))
+        
+        # only get complete single_copy_busco_sequences
+        scbs_set = set(result.ids_with("Complete"))
             
         data[assembly] = scbs_set
         all_busco_hits.update(scbs_set)
             
         
-    # got all data, now create dataframe...
-    busco_table = pd.DataFrame(data=False, dtype=bool, index=sorted(data.keys()), columns=sorted(all_busco_hits))
-    # ...and fill with values
-    for assembly, hits_set in data.items():
-        for hit in hits_set:
-            busco_table.loc[assembly, hit] = True
+    # got all data, now create dataframe
+    busco_table = make_matrix(data, all_busco_hits)
     #print(busco_table.head())    
     
     # Finalize. 
     print("Checked {} result folders".format(num+1))
-    busco_table.to_csv("./busco_a-p_matrix.tsv", sep="\t")
+    if args.format in ("tsv", "both"):
+        busco_table.to_csv("./busco_a-p_matrix.tsv", sep="\t")
+    if args.format in ("binary", "both"):
+        save_matrix(busco_table, "./busco_a-p_matrix.bin")
     
     
     
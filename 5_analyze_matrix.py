@@ -8,12 +8,21 @@ import sys
 import os
 import argparse
 from pathlib import Path
+import numpy as np
 import pandas as pd
+from busco_matrix import is_binary_matrix, load_matrix
+
+# levels of presence in (filtered) assemblies reported for the genes
+PRESENCE_LEVELS = [1.0, 0.95, 0.9]
+
+# number of bits set in each byte
+POPCOUNT = np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
 
 
 def arg_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--matrix", help="Path to tsv busco a/p matrix",
+    parser.add_argument("-m", "--matrix", help="Path to busco a/p matrix (tsv or \
+        binary)",
         required=True, type=Path)
     parser.add_argument("-l", "--links", help="Path to 'links_to_ODB10.txt' \
         file, which contains information about the BUSCO genes. It will be \
@@ -26,9 +35,170 @@ def arg_parser():
         number of total Busco hits in the set) necessary to pass to downstream \
         analysis. Assemblies below this number will also be reported. Default: \
         0.7", type=float, default=0.7)
+    parser.add_argument("--sweep_thresholds", help="Sweep mode: range of \
+        completeness thresholds ('start:stop:step', or a comma-separated list). \
+        Writes matrix_analysis_sweep.tsv instead of the usual reports", 
+        type=parse_range)
+    parser.add_argument("--sweep_occupancy", help="Sweep mode: range of gene \
+        occupancy levels (fraction of kept assemblies in which a gene is found; \
+        'start:stop:step' or a comma-separated list). Default: 1.0,0.95,0.9",
+        type=parse_range)
+    parser.add_argument("--optimize", help="Optimization mode: searches for a \
+        large block of assemblies and BUSCOs in which every assembly has at \
+        least this fraction of the genes, and every gene is found in at least \
+        this fraction of the assemblies. Writes the 'Optimized' reports instead \
+        of the usual ones", type=float)
+    parser.add_argument("--lengths", help="Sweep mode: path to the \
+        'lengths_cutoff' file of the BUSCO dataset. Used to report the \
+        expected length (in aa) of the concatenated genes. Optional", type=Path)
     return parser.parse_args()
 
 
+def parse_range(text):
+    """
+    'start:stop:step' (stop included) or a comma-separated list of numbers
+    """
+    try:
+        if ":" in text:
+            start, stop, step = [float(x) for x in text.split(":")]
+            values = np.arange(start, stop + step/2, step)
+        else:
+            values = [float(x) for x in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected 'start:stop:step' or a list of numbers")
+    values = sorted(set(round(float(x), 4) for x in values))
+    if not values or values[0] < 0.0 or values[-1] > 1.0:
+        raise argparse.ArgumentTypeError("values must be in the range [0.0, 1.0]")
+    return values
+
+
+def read_lengths(filepath):
+    """
+    BUSCO id -> expected length, from the 'lengths_cutoff' file of a dataset
+    """
+    lengths = dict()
+    with open(filepath) as f:
+        for line in f:
+            x = line.split()
+            if len(x) < 4:
+                continue
+            lengths[x[0]] = float(x[3])
+    return lengths
+
+
+def optimize_block(matrix, target):
+    """
+    Greedy search of a large block of the a/p matrix in which every row and 
+    every column has at least 'target' occupancy: the worst assembly or gene 
+    is removed until the block meets the target, then removed assemblies and 
+    genes are added back (best first) as long as the block still meets it.
+    The matrix is kept bit-packed (by rows and by columns), and the number of 
+    hits of every row and column is updated with each change.
+    Returns boolean masks of the kept rows and columns
+    """
+    n_rows, n_columns = matrix.shape
+    packed_rows = np.packbits(matrix, axis=1)
+    packed_columns = np.packbits(matrix.T, axis=1)
+    
+    # hits of every row within the kept columns, and vice versa
+    row_hits = POPCOUNT[packed_rows].sum(axis=1, dtype=np.int64)
+    column_hits = POPCOUNT[packed_columns].sum(axis=1, dtype=np.int64)
+    kept_rows = np.ones(n_rows, dtype=bool)
+    kept_columns = np.ones(n_columns, dtype=bool)
+    rows_left = n_rows
+    columns_left = n_columns
+    
+    # pruning
+    while rows_left and columns_left:
+        row_occupancy = np.where(kept_rows, row_hits / columns_left, np.inf)
+        column_occupancy = np.where(kept_columns, column_hits / rows_left, np.inf)
+        r = int(np.argmin(row_occupancy))
+        c = int(np.argmin(column_occupancy))
+        if row_hits[r] >= int(target * columns_left) and \
+            column_hits[c] >= int(target * rows_left):
+            break
+        
+        if row_occupancy[r] <= column_occupancy[c]:
+            kept_rows[r] = False
+            rows_left -= 1
+            column_hits -= np.unpackbits(packed_rows[r], count=n_columns)
+        else:
+            kept_columns[c] = False
+            columns_left -= 1
+            row_hits -= np.unpackbits(packed_columns[c], count=n_rows)
+    
+    # adding back
+    changed = True
+    while changed and rows_left and columns_left:
+        changed = False
+        for r in np.argsort(-row_hits, kind="stable"):
+            if kept_rows[r]:
+                continue
+            if row_hits[r] < int(target * columns_left):
+                break
+            bits = np.unpackbits(packed_rows[r], count=n_columns)
+            # kept genes must still meet the target with one more assembly
+            if np.any(kept_columns & (column_hits + bits < int(target * (rows_left + 1)))):
+                continue
+            kept_rows[r] = True
+            rows_left += 1
+            column_hits += bits
+            changed = True
+        
+        for c in np.argsort(-column_hits, kind="stable"):
+            if kept_columns[c]:
+                continue
+            if column_hits[c] < int(target * rows_left):
+                break
+            bits = np.unpackbits(packed_columns[c], count=n_rows)
+            if np.any(kept_rows & (row_hits + bits < int(target * (columns_left + 1)))):
+                continue
+            kept_columns[c] = True
+            columns_left += 1
+            row_hits += bits
+            changed = True
+    
+    return kept_rows, kept_columns
+
+
+def sweep(matrix, completeness, columns, thresholds, occupancies, gene_lengths):
+    """
+    Evaluates every combination of completeness threshold and gene occupancy.
+    matrix: boolean numpy array (rows: assemblies, columns: BUSCOs)
+    completeness: number of BUSCO hits of each assembly
+    columns: number of columns used to calculate the minimum hits (as in 
+    the single threshold analysis)
+    gene_lengths: expected length of each BUSCO (numpy array)
+    Returns a list of (threshold, minimum hits, assemblies kept, occupancy, 
+    minimum assemblies, genes retained, expected length) tuples
+    """
+    # assemblies sorted by completeness: every threshold keeps a prefix of 
+    # them, so the presence of each gene is accumulated only once
+    order = np.argsort(-completeness, kind="stable")
+    sorted_completeness = completeness[order]
+    presence = np.zeros(matrix.shape[1], dtype=np.int64)
+    kept = 0
+
+    rows = list()
+    for t in sorted(thresholds, reverse=True):
+        minimum_hits = int(columns * t)
+        new_kept = int(np.count_nonzero(sorted_completeness >= minimum_hits))
+        if new_kept > kept:
+            presence += matrix[order[kept:new_kept]].sum(axis=0)
+            kept = new_kept
+
+        # genes sorted by presence, to count them (and their lengths) with a search
+        gene_order = np.argsort(presence, kind="stable")
+        sorted_presence = presence[gene_order]
+        length_sums = np.concatenate(([0.0], np.cumsum(gene_lengths[gene_order][::-1])))
+        for asm_perc in sorted(occupancies, reverse=True):
+            asms = int(asm_perc * kept)
+            genes = len(presence) - int(np.searchsorted(sorted_presence, asms, side="left"))
+            rows.append((t, minimum_hits, kept, asm_perc, asms, genes, length_sums[genes]))
+    return rows
+
+
+
 if __name__ == "__main__":
     args = arg_parser()
     
@@ -39,6 +209,8 @@ if __name__ == "__main__":
     t = args.threshold
     if t < 0.0 or t > 1.0:
         sys.exit("Error: --threshold argument must be in the range [0.0, 1.0]")
+    if args.optimize is not None and (args.optimize < 0.0 or args.optimize > 1.0):
+        sys.exit("Error: --optimize argument must be in the range [0.0, 1.0]")
     
     gene_info = dict()
     if args.links:
@@ -57,7 +229,10 @@ if __name__ == "__main__":
                 asm_info[x[0]] = "\t".join(x[1:])
     
     # read Busco Hits dataframe
-    bh = pd.read_csv(i, sep="\t", header=0, index_col=0)
+    if is_binary_matrix(i):
+        bh = load_matrix(i)
+    else:
+        bh = pd.read_csv(i, sep="\t", header=0, index_col=0)
     print("Got a dataframe of {} assemblies and {} busco genes.".format(len(bh.index), len(bh.columns)))
     
     # make a new dataframe: completeness
@@ -67,6 +242,50 @@ if __name__ == "__main__":
     print()
     
     
+    if args.sweep_thresholds or args.sweep_occupancy:
+        thresholds = args.sweep_thresholds if args.sweep_thresholds else [t]
+        occupancies = args.sweep_occupancy if args.sweep_occupancy else PRESENCE_LEVELS
+        gene_lengths = np.zeros(len(bh.columns)-1)
+        if args.lengths:
+            lengths = read_lengths(args.lengths)
+            gene_lengths = np.array([lengths.get(g, 0.0) for g in bh.columns[:-1]])
+        
+        matrix = bh.iloc[:, :-1].to_numpy(dtype=bool)
+        completeness = bh["Completeness"].to_numpy()
+        rows = sweep(matrix, completeness, len(bh.columns), thresholds, occupancies, gene_lengths)
+        
+        with open("matrix_analysis_sweep.tsv", "w") as f:
+            f.write("Completeness threshold\tMinimum BUSCO hits\tAssemblies kept\tTarget asm. enrichment %\tTarget asm. enrichment #\tBUSCOs found in target num. of asms.\tExpected concatenated length\n")
+            for row in rows:
+                length = "{:.0f}".format(row[6]) if args.lengths else "NA"
+                f.write("{:.4g}\t{}\t{}\t{:.4g}\t{}\t{}\t{}\n".format(*row[:6], length))
+        print("Evaluated {} combinations of {} completeness thresholds and {} occupancy levels".format(
+            len(rows), len(thresholds), len(occupancies)))
+        print("Results written to matrix_analysis_sweep.tsv")
+        sys.exit()
+    
+    if args.optimize is not None:
+        target = args.optimize
+        matrix = bh.iloc[:, :-1].to_numpy(dtype=bool)
+        kept_rows, kept_columns = optimize_block(matrix, target)
+        assemblies = bh.index[kept_rows]
+        genes = bh.columns[:-1][kept_columns]
+        
+        filled = 0.0
+        if len(assemblies) and len(genes):
+            filled = matrix[np.ix_(kept_rows, kept_columns)].mean()
+        print("Optimized block for {} occupancy: {}/{} assemblies and {}/{} busco genes ({:.4f} of the block filled)".format(
+            target, len(assemblies), len(bh.index), len(genes), len(bh.columns)-1, filled))
+        
+        with open("matrix_analysis_Optimized_{:04.2f}_Assemblies.tsv".format(target), "w") as f:
+            f.write(report_header)
+            for asm in assemblies:
+                f.write("{}\t{}\n".format(asm, asm_info.get(asm, "\t\t\t\t\t")))
+        with open("matrix_analysis_S_genes_in_Optimized_{:04.2f}_block.tsv".format(target), "w") as f:
+            for g in genes:
+                f.write("{}\t{}\n".format(g, gene_info.get(g, "\t")))
+        sys.exit()
+    
     # Filter data frame based on requested completeness threshold
     # i.e. find "good" assemblies
     minimum_hits = int(len(bh.columns) * t) # calculate minimum busco hits based on threshold
@@ -99,7 +318,7 @@ if __name__ == "__main__":
     # i.e. analyze columns to find "good" genes
     print("\nBUSCO hits analysis (on {} filtered assemblies)".format(len(filtered_bh)))
     print("Target asm. enrichment %\tTarget asm. enrichment #\tBUSCOs found in target num. of asms.")
-    for asm_perc in [1.0, 0.95, 0.9]:
+    for asm_perc in PRESENCE_LEVELS:
         # basically, filter all gene labels with 'asms' or higher presence in assemblies
         asms = int(asm_perc * len(filtered_bh.index)) # min. num of assemblies the gene must be found (S)
         
@@ -11,10 +11,14 @@ Extracts sequences of each Target Gene, for each Filtered Assemblies
 
 import sys
 import os
-import io
 import argparse
+import tempfile
 from pathlib import Path
-from zipfile import ZipFile, BadZipFile
+from shutil import rmtree, copyfileobj
+from multiprocessing import Pool
+from busco_results import BuscoResult
+from busco_catalog import BuscoCatalog
+from fasta_io import parse_fasta, wrap
 
 
 def parameters_parser():
@@ -31,6 +35,18 @@ def parameters_parser():
         type=Path, default="./output/Target_Genes_unaligned")
     parser.add_argument("--aa", help="Extract protein sequences instead of DNA",
         default=False, action="store_true")
+    parser.add_argument("--both", help="Extract both DNA and protein sequences \
+        (in one pass), into the 'dna' and 'aa' subfolders of the output folder",
+        default=False, action="store_true")
+    parser.add_argument("--memory", help="Memory (MB) used (by each process) to \
+        keep sequences before they are written to the gene files. Default: 256", type=float,
+        default=256)
+    parser.add_argument("-p", "--processes", help="Number of processes. The \
+        assemblies are split among them, and their partial gene files are \
+        merged at the end. Default: 1", type=int, default=1)
+    parser.add_argument("-c", "--catalog", help="Catalog of BUSCO results \
+        (created if it doesn't exist). Only new or changed results will be read \
+        (Optional)", type=Path)
     return parser.parse_args() 
 
 
@@ -49,19 +65,80 @@ def read_list(filepath):
         return rset
 
 
-def sequence80(seq):
+def extract(assemblies, genes, suffixes, gene_files, memory):
+    """
+    Writes the sequences ('fna' and/or 'faa' suffixes) of every gene of the
+    assemblies (BuscoResult, in this order) to gene_files ((gene, suffix) -> 
+    path).
+    Every assembly is opened once, and its sequences are added to the 
+    buffers of each gene, which are written when they use too much memory
+    """
+    with GeneBuffers(gene_files, memory) as buffers:
+        for result in assemblies:
+            asm = result.assembly
+            with result.open_sequences() as reader:
+                for gene in genes:
+                    name = "{}_{}".format(gene, asm)
+                    # only complete, single-copy genes have a sequence file
+                    complete = result.status(gene) == "Complete"
+                    for suffix in suffixes:
+                        try:
+                            if not complete:
+                                raise KeyError(gene)
+                            text = reader.single_copy(gene, suffix)
+                        # this assembly doesn't have a copy of this (S) gene
+                        except KeyError:
+                            buffers.write((gene, suffix), ">{}\n".format(name))
+                        else:
+                            old_header, seq = next(parse_fasta(text), ("", ""))
+                            new_header = ">{} {}".format(name, old_header.split(" ")[0])
+                            
+                            buffers.write((gene, suffix), "{}\n{}".format(new_header, wrap(seq)))
+
+
+def extract_shard(job):
+    """
+    extract() for multiprocessing.Pool
+    """
+    extract(*job)
+
+
+class GeneBuffers:
     """
-    Re-formats a sequence to limit to 80 columns
+    Output text of each gene file, kept in memory until all buffers together
+    use more than 'memory' bytes. Then, all of them are appended to their files.
+    gene_files: key (e.g. gene and suffix) -> path
     """
-    length = len(seq)
-    part_one = "\n".join([seq[row*80:(row+1)*80] for row in \
-            range(length // 80)])
+    def __init__(self, gene_files, memory):
+        self.gene_files = gene_files
+        self.memory = memory
+        self.buffers = {gene: list() for gene in gene_files}
+        self.size = 0
         
-    part_two = ""
-    remainder = length % 80
-    if remainder > 0:
-        part_two = "{}\n".format(seq[-remainder:])
-    return "{}\n{}".format(part_one, part_two)
+        # start with empty files
+        for filepath in gene_files.values():
+            open(filepath, "w").close()
+    
+    def write(self, gene, text):
+        self.buffers[gene].append(text)
+        self.size += len(text)
+        if self.size > self.memory:
+            self.flush()
+    
+    def flush(self):
+        for gene, buffer in self.buffers.items():
+            if not buffer:
+                continue
+            with open(self.gene_files[gene], "a") as f:
+                f.write("".join(buffer))
+            buffer.clear()
+        self.size = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.flush()
     
     
 if __name__ == "__main__":
@@ -78,64 +155,82 @@ if __name__ == "__main__":
     if not o.is_dir():
         os.makedirs(o, exist_ok=True)
         
-    # Choose DNA or AA output
-    suffix = "fna"
-    file_type = "dna"
-    if args.aa:
-        suffix = "faa"
-        file_type = "aa"
+    if args.aa and args.both:
+        sys.exit("Error: use either --aa or --both")
+    
+    # Choose DNA and/or AA output: (suffix, file type, folder)
+    if args.both:
+        outputs = [("fna", "dna", o / "dna"), ("faa", "aa", o / "aa")]
+        for _, _, folder in outputs:
+            folder.mkdir(exist_ok=True)
+    elif args.aa:
+        outputs = [("faa", "aa", o)]
+    else:
+        outputs = [("fna", "dna", o)]
+    suffixes = [suffix for suffix, _, _ in outputs]
     
-    # Pre-assemble all zip file names, and find out if any of them is missing
-    target_zips = dict()
+    # Read the results of all assemblies, and find out if any of them is missing
+    results = dict()
     not_found = set()
+    catalog_results = None
+    if args.catalog:
+        # only new or changed results are read again
+        with BuscoCatalog(args.catalog) as catalog:
+            catalog.update(base_folder)
+            catalog_results = catalog.results(base_folder, FilteredAssemblies)
     for asm in FilteredAssemblies:
-        asm_folder = base_folder / asm
-        rfs = list(asm_folder.glob("run_*"))
-        try:
-            assert(len(rfs) == 1)
-        except AssertionError:
-            print(f"Can't find the run folder for assembly {asm}")
-            continue
-        run_folder = rfs[0]
-        
-        # get either the folder or its compressed version
-        if (run_folder / "busco_sequences.zip").is_file():
-            target_zips[asm] = run_folder / "busco_sequences.zip"
-        elif (run_folder / "busco_sequences/single_copy_busco_sequences").is_dir():
-            target_zips[asm] = run_folder / "busco_sequences/single_copy_busco_sequences/"
+        if catalog_results is not None:
+            result = catalog_results.get(asm)
+            if result is None:
+                print(f"Can't find the run folder for assembly {asm}")
+                continue
         else:
+            try:
+                result = BuscoResult(base_folder / asm)
+            except FileNotFoundError:
+                print(f"Can't find the run folder for assembly {asm}")
+                continue
+        
+        if result.sequences is None:
             not_found.add(asm)
+        else:
+            results[asm] = result
             
     if not_found:
         print("Not found: {} BUSCO 'busco_sequences' zip".format(len(not_found)))
         sys.exit(", ".join(not_found))
     
-    for gene in TargetGenes:
-        with open(o / "{}.{}.fasta".format(gene, file_type), "w") as f:
-            for asm in sorted(FilteredAssemblies - not_found):
-                target = target_zips[asm]
-                
-                if target.is_file():
-                    with ZipFile(target_zip) as z:
-                        try:
-                            with io.TextIOWrapper(z.open("busco_sequences/single_copy_busco_sequences/{}.{}".format(gene, suffix)), encoding="utf-8") as fasta:
-                                old_header = str(fasta.readline())[1:].split(" ")[0]
-                                new_header = ">{}_{} {}".format(gene, asm, old_header)
-                                seq = "".join([str(l).strip() for l in fasta.readlines()])
-                                
-                                f.write("{}\n".format(new_header))
-                                f.write(sequence80(seq))
-                        # this assembly doesn't have a copy of this (S) gene
-                        except KeyError:
-                            f.write(">{}_{}\n".format(gene, asm))
-                else:
-                    try:
-                        with open(target / f"{gene}.{suffix}") as fasta:
-                            old_header = str(fasta.readline())[1:].split(" ")[0]
-                            new_header = ">{}_{} {}".format(gene, asm, old_header.strip())
-                            seq = "".join([str(l).strip() for l in fasta.readlines()])
-                            
-                            f.write("{}\n".format(new_header))
-                            f.write(sequence80(seq))
-                    except IOError:
-                        f.write(">{}_{}\n".format(gene, asm))
+    gene_files = dict()
+    for suffix, file_type, folder in outputs:
+        for gene in TargetGenes:
+            gene_files[(gene, suffix)] = folder / "{}.{}.fasta".format(gene, file_type)
+    memory = int(args.memory * 1024 * 1024)
+    assemblies = [results[asm] for asm in sorted(results)]
+    
+    if args.processes > 1:
+        # Contiguous shards of the sorted assemblies: the partial files of 
+        # each gene are merged in shard order
+        parts_folder = Path(tempfile.mkdtemp(prefix=".parts_", dir=o))
+        try:
+            shards = max(1, min(len(assemblies), args.processes * 4))
+            jobs = list()
+            for n in range(shards):
+                shard_folder = parts_folder / str(n)
+                shard_folder.mkdir()
+                part_files = {key: shard_folder / path.name for key, path in gene_files.items()}
+                jobs.append((assemblies[n*len(assemblies)//shards:(n+1)*len(assemblies)//shards], 
+                    TargetGenes, suffixes, part_files, memory))
+        
+            with Pool(processes=args.processes) as pool:
+                pool.map(extract_shard, jobs, chunksize=1)
+        
+            for path in gene_files.values():
+                with open(path, "wb") as f:
+                    for n in range(shards):
+                        with open(parts_folder / str(n) / path.name, "rb") as part:
+                            copyfileobj(part, f, 1024*1024)
+        finally:
+            # also when a worker fails or the run is interrupted
+            rmtree(parts_folder, ignore_errors=True)
+    else:
+        extract(assemblies, TargetGenes, suffixes, gene_files, memory)
@@ -9,14 +9,19 @@ Output:
 
 Uses MAFFT to make multiple sequence alignments of all Target Genes
 It also curates the alignments using trimal "gappyout" strategy
+
+Genes are aligned from the most to the least expensive (number of sequences
+x mean length). With --cores, each MAFFT process gets a number of threads
+proportional to its cost relative to the most expensive gene, out of a total
+number of cores
 """
 
 import sys
 import os
 import argparse
 from pathlib import Path
-from multiprocessing import Pool
-from subprocess import run, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from subprocess import run, PIPE, DEVNULL, CalledProcessError
 
 
 def parameters_parser():
@@ -29,12 +34,53 @@ def parameters_parser():
         aligned sequence files (using command 'trimal -gappyout')", 
         required=True, type=Path)
     parser.add_argument("-p", "--processes", help="Number of MAFFT instances. \
-        Default: 1", type=int, default=1)
+        Not used with --cores. Default: 1", type=int)
     parser.add_argument("--threads", help="--threads parameter for each \
-        MAFFT process. Default: 2", type=int, default=1)
+        MAFFT process. Not used with --cores. Default: 1", type=int)
+    parser.add_argument("-c", "--cores", help="Total number of cores used by \
+        all MAFFT processes. Each process gets threads according to the size \
+        of its gene, so that small genes run single-threaded and many at the \
+        same time", type=int)
+    parser.add_argument("--max_threads", help="With --cores, number of \
+        threads of the MAFFT process of the most expensive gene. Default: a \
+        quarter of --cores", type=int)
     return parser.parse_args()
 
 
+def alignment_cost(fasta):
+    """
+    Expected cost of aligning a fasta file: number of sequences x mean length,
+    i.e. the total number of residues (without parsing the sequences)
+    """
+    residues = 0
+    with open(fasta, "rb") as f:
+        for line in f:
+            if not line.startswith(b">"):
+                residues += len(line.strip())
+    return residues
+
+
+def threads_for_gene(cost, largest, max_threads):
+    """
+    Number of threads for a gene, proportional to its cost relative to the
+    most expensive gene in the set. Unlike cpus_for_genome() in step 2, it
+    rounds down, so that small genes stay single-threaded
+    """
+    if largest <= 0:
+        return 1
+    return max(1, min(max_threads, int(max_threads * cost / largest)))
+
+
+def schedule(jobs, max_threads):
+    """
+    jobs: list of (cost, fasta)
+    Returns a list of (fasta, threads), most expensive first
+    """
+    jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+    largest = jobs[0][0] if jobs else 0
+    return [(fasta, threads_for_gene(cost, largest, max_threads)) for cost, fasta in jobs]
+
+
 def do_mafft(fasta, algn, trimmed_algn, thread):
     cmd = ["mafft", "--auto", "--quiet", "--thread", str(thread), str(fasta)]
     print(" ".join(cmd))
@@ -52,10 +98,38 @@ def do_mafft(fasta, algn, trimmed_algn, thread):
         print("\t{}".format(" ".join(cmd)))
         # NOTE: use capture_output=True but don't use it; to suppress warnings
         # about empty sequences
-        proc_trimal = run(cmd, check=True, capture_output=True)
+        try:
+            proc_trimal = run(cmd, check=True, capture_output=True)
+        except CalledProcessError:
+            print("Error running '{}'".format(" ".join(cmd)))
     return
 
 
+def run_jobs(scheduled, cores, aligned_folder, trimmed_folder):
+    """
+    Launches the jobs in order as soon as there are enough free cores for
+    the next one
+    """
+    free = cores
+    running = dict() # key: future, value: threads
+    with ThreadPoolExecutor(max_workers=cores) as executor:
+        for fasta, threads in scheduled:
+            while running and free < threads:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    free += running.pop(future)
+                    future.result()
+
+            aligned_file = aligned_folder / "{}.algn".format(fasta.stem)
+            trimmed_algn = trimmed_folder / "{}.trimal.algn".format(fasta.stem)
+            future = executor.submit(do_mafft, fasta, aligned_file, trimmed_algn, threads)
+            running[future] = threads
+            free -= threads
+
+        for future in running:
+            future.result()
+
+
 if __name__ == "__main__":
     pars = parameters_parser()
     
@@ -71,13 +145,21 @@ if __name__ == "__main__":
     if not t.is_dir():
         os.makedirs(t, exist_ok=True)
         
-    with Pool(pars.processes) as pool:
-    #if True: # comment above and uncomment this for serialized processing
-        for fasta in i.glob("*.fasta"):
-            aligned_file = o / "{}.algn".format(fasta.stem)
-            trimmed_algn = t / "{}.trimal.algn".format(fasta.stem)
-            pool.apply_async(do_mafft, args=(fasta, aligned_file, trimmed_algn, pars.threads, ))
-            #do_mafft(fasta, aligned_file, trimmed_algn, pars.threads) # comment above and uncomment this for serialized processing
-        pool.close()
-        pool.join()
-
+    jobs = [(alignment_cost(fasta), fasta) for fasta in i.glob("*.fasta")]
+    
+    if pars.cores is not None:
+        if pars.processes is not None or pars.threads is not None:
+            print("Warning: --processes and --threads are not used with --cores")
+        cores = pars.cores
+        if cores < 1:
+            sys.exit("Error, the number of cores must be at least 1")
+        max_threads = pars.max_threads if pars.max_threads else max(1, cores // 4)
+        scheduled = schedule(jobs, min(cores, max_threads))
+    else:
+        # fixed number of MAFFT processes and threads, largest genes first
+        processes = pars.processes if pars.processes else 1
+        threads = pars.threads if pars.threads else 1
+        cores = processes * threads
+        scheduled = [(fasta, threads) for fasta, _ in schedule(jobs, 1)]
+    
+    run_jobs(scheduled, cores, o, t)
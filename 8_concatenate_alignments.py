@@ -11,10 +11,11 @@ Expects headers to be in the format
 
 import sys
 import os
-import io
 import argparse
-from collections import defaultdict
 from pathlib import Path
+from contextlib import ExitStack
+import numpy as np
+import fasta_io
 
 
 def parameters_parser():
@@ -23,76 +24,196 @@ def parameters_parser():
         required=True, type=Path)
     parser.add_argument("-n", "--name", help="Base name for the output", \
         type=str, required=True)
+    parser.add_argument("--missing_char", help="Character used for the genes \
+        that are missing in an assembly. Default: '-'", type=str, default="-")
+    parser.add_argument("-f", "--formats", help="Formats of the concatenated \
+        alignment: fasta (80 columns), phylip (relaxed, one line per assembly) \
+        and/or nexus (data and sets blocks). Default: fasta", nargs="+",
+        choices=["fasta", "phylip", "nexus"], default=["fasta"])
+    parser.add_argument("--raxml_model", help="Model written for each gene in \
+        the RAxML partition file. Default: GTR+G for nucleotides, LG+G for \
+        proteins", type=str)
     return parser.parse_args()
 
 
-def read_fasta(fasta: Path, data: dict) -> str:
-    """
-    fasta: Path object to each fasta file
-    data: dictionary where key: acc, value: a list of sequences
+NUCLEOTIDES = "ACGTURYKMSWBDHVN-?."
+
+# default model of each gene in the RAxML partition file
+RAXML_MODELS = {"dna": "GTR+G", "protein": "LG+G"}
+
 
-    All headers should have the format
-    >[BUSCO id]_[assembly acc.] [optional: description]
+def split_header(header: str) -> tuple:
     """
+    Returns the BUSCO id and the assembly accession of a header with the format
+    [BUSCO id]_[assembly acc.] [optional: description]
+    """
+    header = header.split(" ")[0] # get rid of description
+    gene_id = header.split("_")[0]
+    acc = "_".join(header.split("_")[1:])
+    return gene_id, acc
 
-    gene_id = ""
 
+def scan_alignment(fasta: Path) -> tuple:
+    """
+    Reads the headers and sequence lengths (not the sequences) of an alignment.
+    Records without sequence are genes missing in that accession.
+    Returns the BUSCO id, the list of accessions and the alignment length (0
+    if no record has sequence)
+    """
+    gene_id = ""
+    accessions = list()
     sequence_lengths = set() # use to detect any possible variation
-    with open(fasta) as f:
-        header = ""
-        acc = ""
-        sequence = list()
-        
-        for line in f:
-            if line.strip() == "":
-                continue
-            
-            if line[0] == ">":
-                # First time; we have no accession yet
-                if header != "":
-                    # there shouldn't be headers without sequences; 
-                    # even missing genes should have deletion characters
-                    assert(sequence)
-
-                    data[acc].append("".join(sequence))
-                    sequence_lengths.add(len(data[acc]))
-                    sequence = list()
-                
-                header = line[1:].split(" ")[0].strip() # get rid of description
-                if gene_id == "":
-                    gene_id = header.split("_")[0]
-                elif gene_id != header.split("_")[0]:
-                        sys.exit("Error! found a different gene id in {}: {}, {}".format(fasta, gene_id, header.split("_")[0]))
-                acc = "_".join(header.split("_")[1:])
-                    
-            else:
-                sequence.append(line.strip())
-
-        # record the last sequence
-        assert(sequence)
-        data[acc].append("".join(sequence))
-        sequence_lengths.add(len(data[acc]))
-
-
-    if len(sequence_lengths) != 1:
+    for header, length in fasta_io.read_lengths(fasta):
+        header_gene_id, acc = split_header(header)
+        if gene_id == "":
+            gene_id = header_gene_id
+        elif gene_id != header_gene_id:
+                sys.exit("Error! found a different gene id in {}: {}, {}".format(fasta, gene_id, header_gene_id))
+        accessions.append(acc)
+        if length:
+            sequence_lengths.add(length)
+
+    if len(sequence_lengths) > 1:
         sys.exit("Error! found {} different sequence lengths in {}".format(len(sequence_lengths), fasta))
+    if len(set(accessions)) != len(accessions):
+        sys.exit("Error! found repeated accessions in {}".format(fasta))
+
+    length = sequence_lengths.pop() if sequence_lengths else 0
+    return gene_id, accessions, length
+
+
+class Supermatrix:
+    """
+    Concatenation of alignments in a single array with one byte per position.
+    The alignments are first scanned (add) to know the accessions and the
+    position of every partition; then the array is allocated, filled with the
+    missing character, and the sequences are copied into their columns (fill)
+    """
+    def __init__(self, missing_char="-"):
+        self.missing = ord(missing_char)
+        self.partitions = list() # (gene id, first column, length) of each alignment
+        self.files = list() # alignment file of each partition
+        self.genes = list() # number of accessions with each gene
+        self.taxa = dict() # key: acc, value: number of genes (order of appearance)
+        self.length = 0
+        self.matrix = None
+
+    def add(self, fasta, gene_id, accessions, length):
+        """
+        Adds a scanned alignment (see scan_alignment). Alignments without any
+        position only add their accessions
+        """
+        for acc in accessions:
+            self.taxa.setdefault(acc, 0)
+        if length == 0:
+            return
+        self.partitions.append((gene_id, self.length, length))
+        self.files.append(fasta)
+        self.length += length
+
+    def fill(self):
+        rows = {acc: n for n, acc in enumerate(self.taxa)}
+        self.matrix = np.full((len(rows), self.length), self.missing, dtype=np.uint8)
+        for fasta, (_, start, length) in zip(self.files, self.partitions):
+            present = 0
+            for header, seq in fasta_io.read_fasta(fasta, as_bytes=True):
+                if not seq:
+                    continue
+                _, acc = split_header(header)
+                self.matrix[rows[acc], start:start+length] = np.frombuffer(seq, dtype=np.uint8)
+                # only sequences with any character that is not a gap count
+                # for occupancy
+                if seq.strip(b"-?"):
+                    self.taxa[acc] += 1
+                    present += 1
+            self.genes.append(present)
+
+    def datatype(self):
+        """
+        'dna' if all characters are nucleotides (IUPAC codes), gaps or
+        missing; 'protein' otherwise
+        """
+        # one row at a time (bincount works on a copy as integers)
+        characters = np.zeros(256, dtype=np.int64)
+        for row in self.matrix:
+            characters += np.bincount(row, minlength=256)
+        seen = {chr(c).upper() for c in np.flatnonzero(characters)}
+        seen.discard(chr(self.missing))
+        if seen <= set(NUCLEOTIDES):
+            return "dna"
+        return "protein"
+
+    def rows(self):
+        """
+        Yields (acc, row) of each accession
+        """
+        for acc, row in zip(self.taxa, self.matrix):
+            yield acc, row
+
+
+def fraction(count, total) -> float:
+    return count / total if total else 0.0
+
+
+def sets_block(partitions) -> str:
+    """
+    Nexus block with the charset of each gene (without the final new line)
+    """
+    charsets = [f"\tcharset\t{gene_id} = {start+1}-{start+length};\n"
+        for gene_id, start, length in partitions]
+    return "begin sets;\n" + "".join(charsets) + "end;"
+
+
+class FastaWriter:
+    """
+    Writes the concatenated alignment one row at a time
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def start(self, taxa, length):
+        pass
+
+    def write(self, acc, row):
+        self.f.write(f">{acc}\n".encode("utf-8"))
+        fasta_io.write_sequence_bytes(self.f, row)
+
+    def end(self, partitions):
+        pass
+
+
+class PhylipWriter(FastaWriter):
+    """
+    Relaxed phylip: sequential, each sequence in a single line after its name
+    """
+    def start(self, taxa, length):
+        self.f.write(f"{taxa} {length}\n".encode("utf-8"))
 
-    return gene_id
+    def write(self, acc, row):
+        self.f.write(f"{acc} ".encode("utf-8"))
+        self.f.write(row.tobytes())
+        self.f.write(b"\n")
 
 
-def sequence80(seq):
+class NexusWriter(PhylipWriter):
     """
-    Re-formats a sequence to limit to 80 columns
+    Nexus file with the alignment (data block) and the partitions (sets block)
     """
-    length = len(seq)
-    part_one = "\n".join([seq[row*80:(row+1)*80] for row in \
-            range(length // 80)])
-        
-    part_two = ""
-    remainder = length % 80
-    if remainder > 0:
-        part_two = "{}\n".format(seq[-remainder:])
-    return "{}\n{}".format(part_one, part_two)
+    def __init__(self, f, datatype, missing_char):
+        self.f = f
+        self.datatype = datatype
+        self.missing = "?" if missing_char == "-" else missing_char
+
+    def start(self, taxa, length):
+        self.f.write("#nexus\nbegin data;\n".encode("utf-8"))
+        self.f.write(f"\tdimensions ntax={taxa} nchar={length};\n".encode("utf-8"))
+        self.f.write(f"\tformat datatype={self.datatype} missing={self.missing} gap=-;\n".encode("utf-8"))
+        self.f.write(b"\tmatrix\n")
+
+    def end(self, partitions):
+        self.f.write(b"\t;\nend;\n\n")
+        self.f.write(sets_block(partitions).encode("utf-8"))
+        self.f.write(b"\n")
 
 
 if __name__ == "__main__":
@@ -103,28 +224,69 @@ if __name__ == "__main__":
     
     if not i.is_dir():
         sys.exit("Error: given input folder is not a valid folder")
-        
-    # three output files concatenated seqs. nexus
-    data = defaultdict(list)
-    geneids = list()
-    for fasta in sorted(i.glob("*.algn")):
-        geneids.append(read_fasta(fasta, data))
-
-
-    with open(f"{args.name}.fasta", "w") as f, open(f"{args.name}.nex", "w") as n:
-        concatenation_lengths = set() # to verify all accs. have all positions
-        for acc, seqs in data.items():
-            f.write(f">{acc}\n")
-            concatenation = "".join(seqs)
-            f.write(sequence80(concatenation))
-            concatenation_lengths.add(len(concatenation))
-
+    if len(args.missing_char) != 1:
+        sys.exit("Error: --missing_char must be a single character")
+    
+    alignments = sorted(i.glob("*.algn"))
+    if not alignments:
+        sys.exit("Error: no alignments (.algn files) in {}".format(i))
+    
+    # First, get the partitions and the accessions from the headers. 
+    # Accessions missing in some alignments are filled with the missing 
+    # character
+    supermatrix = Supermatrix(args.missing_char)
+    for fasta in alignments:
+        gene_id, accessions, length = scan_alignment(fasta)
+        if length == 0:
+            print("Warning: no sequences in {}, gene {} not included".format(fasta, gene_id))
+        supermatrix.add(fasta, gene_id, accessions, length)
+    if supermatrix.length == 0:
+        sys.exit("Error: no sequences in any alignment of {}".format(i))
+    
+    # Then fill the supermatrix
+    supermatrix.fill()
+    
+    # concatenated alignment in each format, written in one pass
+    datatype = supermatrix.datatype()
+    with ExitStack() as stack:
+        outputs = list()
+        if "fasta" in args.formats:
+            outputs.append(FastaWriter(stack.enter_context(open(f"{args.name}.fasta", "wb"))))
+        if "phylip" in args.formats:
+            outputs.append(PhylipWriter(stack.enter_context(open(f"{args.name}.phy", "wb"))))
+        if "nexus" in args.formats:
+            outputs.append(NexusWriter(stack.enter_context(open(f"{args.name}.nexus", "wb")),
+                datatype, args.missing_char))
+        for output in outputs:
+            output.start(len(supermatrix.taxa), supermatrix.length)
+        for acc, row in supermatrix.rows():
+            for output in outputs:
+                output.write(acc, row)
+        for output in outputs:
+            output.end(supermatrix.partitions)
+    
+    # partition files: nexus (IQ-Tree) and RAxML
+    with open(f"{args.name}.nex", "w") as n:
         n.write("#nexus\n")
-        n.write("begin sets;\n")
-        current_position = 1
-        for i in range(len(data[acc])):
-            gene_id = geneids[i]
-            seq = data[acc][i]
-            n.write(f"\tcharset\t{gene_id} = {current_position}-{current_position+len(seq)-1};\n")
-            current_position += len(seq)
-        n.write("end;")
\ No newline at end of file
+        n.write(sets_block(supermatrix.partitions))
+    
+    model = args.raxml_model if args.raxml_model else RAXML_MODELS[datatype]
+    with open(f"{args.name}.partitions", "w") as f:
+        for gene_id, start, length in supermatrix.partitions:
+            f.write(f"{model}, {gene_id} = {start+1}-{start+length}\n")
+    
+    # occupancy reports
+    genes = len(supermatrix.partitions)
+    taxa = len(supermatrix.taxa)
+    with open(f"{args.name}_occupancy_taxa.tsv", "w") as f:
+        f.write("Assembly\tGenes\tOccupancy\n")
+        for acc, count in supermatrix.taxa.items():
+            f.write("{}\t{}\t{:.4f}\n".format(acc, count, fraction(count, genes)))
+    with open(f"{args.name}_occupancy_genes.tsv", "w") as f:
+        f.write("Gene\tAssemblies\tOccupancy\n")
+        for (gene_id, _, _), count in zip(supermatrix.partitions, supermatrix.genes):
+            f.write("{}\t{}\t{:.4f}\n".format(gene_id, count, fraction(count, taxa)))
+    
+    filled = sum(supermatrix.taxa.values())
+    print("{} assemblies x {} genes ({} positions). {} of {} gene sequences present ({:.2%})".format(
+        taxa, genes, supermatrix.length, filled, taxa * genes, fraction(filled, taxa * genes)))
@@ -0,0 +1,187 @@
+"""
+Packs the results of a BUSCO run (the 'run_[lineage]' folder, including the
+zip files created by step 2) into a single zip file per assembly, with an
+embedded index.
+
+The index is a tab-separated member of the archive with three kinds of lines:
+R   [name of the run folder]
+S   [BUSCO id]  [status in full_table.tsv]
+M   [member name]   [compression method]    [data offset]   [compressed size]   [size]
+and its position is written in the zip comment ("busco_index=[offset],[size]").
+
+Readers only need to read the end of the file and the index to locate any
+member (e.g. one single-copy sequence): the central directory of the zip file
+is never parsed. The archive is still a valid zip file.
+"""
+
+import os
+import zlib
+import struct
+from shutil import copyfileobj
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile, ZIP_DEFLATED, ZIP_STORED
+
+# name of the archive inside each assembly folder
+ARCHIVE_NAME = "busco_run.zip"
+INDEX_NAME = "busco_index.tsv"
+
+SINGLE_COPY_FOLDER = "busco_sequences/single_copy_busco_sequences/"
+
+# zip local file header: signature, versions, flags, method, time, date, crc,
+# sizes, length of file name and of extra field
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+
+
+def data_offset(f, header_offset):
+    """
+    Position of the data of a member, right after its local header
+    """
+    f.seek(header_offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    name_length, extra_length = header[-2:]
+    return header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+
+def read_statuses(full_table):
+    """
+    BUSCO id -> status from a full_table.tsv file (the first line of each id)
+    """
+    statuses = dict()
+    for line in full_table.splitlines():
+        if line.startswith("#") or line.strip() == "":
+            continue
+        x = line.split("\t")
+        if len(x) > 1 and x[0] not in statuses:
+            statuses[x[0]] = x[1]
+    return statuses
+
+
+def pack_run(run_folder, archive, compression=ZIP_DEFLATED, level=6):
+    """
+    Packs a BUSCO run folder into 'archive'. Zip files inside the run folder
+    (e.g. busco_sequences.zip) are unpacked into the archive, so that their
+    members can be indexed
+    """
+    run_folder = Path(run_folder)
+    statuses = dict()
+
+    with ZipFile(archive, "w", compression=compression, compresslevel=level) as z:
+        for root, dirs, files in os.walk(run_folder):
+            dirs.sort()
+            relative_root = Path(root).relative_to(run_folder).as_posix()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = filename if relative_root == "." else "{}/{}".format(relative_root, filename)
+
+                if relative_root == "." and filename.endswith(".zip"):
+                    with ZipFile(path) as inner:
+                        for info in inner.infolist():
+                            if info.is_dir():
+                                continue
+                            with inner.open(info) as source, z.open(info.filename, "w") as target:
+                                copyfileobj(source, target, 1024*1024)
+                    continue
+
+                z.write(path, arcname=name)
+                if name == "full_table.tsv":
+                    with open(path) as f:
+                        statuses = read_statuses(f.read())
+
+    # locate the data of every member...
+    with ZipFile(archive) as z, open(archive, "rb") as f:
+        members = [(info.filename, info.compress_type, data_offset(f, info.header_offset),
+            info.compress_size, info.file_size) for info in z.infolist()]
+
+    lines = ["R\t{}".format(run_folder.name)]
+    for busco_id in sorted(statuses):
+        lines.append("S\t{}\t{}".format(busco_id, statuses[busco_id]))
+    for name, method, offset, compressed_size, size in members:
+        lines.append("M\t{}\t{}\t{}\t{}\t{}".format(name, method, offset, compressed_size, size))
+    index = ("\n".join(lines) + "\n").encode("utf-8")
+
+    # ...add the index (uncompressed)...
+    with ZipFile(archive, "a") as z:
+        z.writestr(INDEX_NAME, index, compress_type=ZIP_STORED)
+        index_header = z.getinfo(INDEX_NAME).header_offset
+
+    # ...and its location in the comment
+    with open(archive, "rb") as f:
+        index_offset = data_offset(f, index_header)
+    with ZipFile(archive, "a") as z:
+        z.comment = "busco_index={},{}".format(index_offset, len(index)).encode("ascii")
+
+
+class BuscoArchive:
+    """
+    Reads members of an archive made by pack_run() using its index
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.f = open(path, "rb")
+        self.run_name = ""
+        self.statuses = dict() # key: BUSCO id. value: status
+        self.members = dict() # key: name. value: (method, offset, compressed size, size)
+
+        try:
+            self.read_index()
+        except (ValueError, IndexError, struct.error) as e:
+            self.f.close()
+            raise BadZipFile("{} has no valid BUSCO index ({})".format(path, e))
+
+    def read_index(self):
+        # the end of central directory record (22 bytes) is followed by the
+        # comment, which has our index location
+        self.f.seek(0, os.SEEK_END)
+        size = self.f.tell()
+        self.f.seek(max(0, size - 1024))
+        tail = self.f.read()
+        eocd = tail.rindex(END_OF_CENTRAL_DIRECTORY)
+        comment = tail[eocd+22:].decode("ascii")
+        if not comment.startswith("busco_index="):
+            raise ValueError("missing index location")
+        offset, length = [int(x) for x in comment.split("=")[1].split(",")]
+
+        self.f.seek(offset)
+        for line in self.f.read(length).decode("utf-8").splitlines():
+            x = line.split("\t")
+            if x[0] == "M":
+                self.members[x[1]] = (int(x[2]), int(x[3]), int(x[4]), int(x[5]))
+            elif x[0] == "S":
+                self.statuses[x[1]] = x[2]
+            elif x[0] == "R":
+                self.run_name = x[1]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self, prefix=""):
+        return [name for name in self.members if name.startswith(prefix)]
+
+    def read(self, name):
+        """
+        Returns the (uncompressed) bytes of a member. KeyError if it's missing
+        """
+        method, offset, compressed_size, size = self.members[name]
+        self.f.seek(offset)
+        data = self.f.read(compressed_size)
+        if method == ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif method != ZIP_STORED:
+            # other methods: let zipfile deal with it
+            with ZipFile(self.path) as z:
+                data = z.read(name)
+        return data
+
+    def single_copy(self, busco_id, suffix):
+        """
+        Text of the single-copy sequence file of a BUSCO id ('fna' or 'faa').
+        KeyError if it's missing
+        """
+        return self.read("{}{}.{}".format(SINGLE_COPY_FOLDER, busco_id, suffix)).decode("utf-8")
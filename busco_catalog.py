@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+
+"""
+Keeps a catalog (SQLite database) of the BUSCO results of a set of
+assemblies, so that steps 3, 4 and 6 don't need to read every result again.
+
+For each assembly it stores the location of the results (run folder or
+archive, relative to the results folder) and its mtime, the reported numbers,
+the status of every BUSCO id, the location of the sequences and the number of
+single-copy sequence files. An assembly is only read again if the mtime of
+its location changes (which happens when step 2 runs BUSCO again, compresses
+or packs the results), or if the location disappears.
+
+Run this file to update a catalog, e.g. after step 2:
+python busco_catalog.py -b Busco_results -c busco_catalog.sqlite
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from busco_results import BuscoResult
+
+# increase when the tables change; older catalogs are rebuilt
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE id_tables (
+    id INTEGER PRIMARY KEY,
+    ids TEXT UNIQUE NOT NULL
+);
+CREATE TABLE assemblies (
+    assembly TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    archive INTEGER NOT NULL,
+    sequences TEXT,
+    C INTEGER, S INTEGER, D INTEGER, F INTEGER, M INTEGER,
+    id_table INTEGER NOT NULL REFERENCES id_tables(id),
+    codes TEXT NOT NULL,
+    single_copy_fna INTEGER,
+    single_copy_faa INTEGER,
+    single_copy_others TEXT
+);
+"""
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Update the catalog of BUSCO results")
+    parser.add_argument("-b", "--buscofolders", help="Path to folder with busco\
+        results (each result is a subfolder)", required=True, type=Path)
+    parser.add_argument("-c", "--catalog", help="Catalog file. It will be \
+        created if it doesn't exist", required=True, type=Path)
+    parser.add_argument("-t", "--threads", help="Number of assemblies read at \
+        the same time. Default: 8", type=int, default=8)
+    return parser.parse_args()
+
+
+def mtime_ns(path):
+    """
+    mtime of a file or folder. None if it doesn't exist
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def read_result(folder):
+    """
+    Reads the results of one assembly, including the single-copy file counts.
+    Returns None if there are no results
+    """
+    try:
+        result = BuscoResult(folder)
+    except FileNotFoundError:
+        return None
+    try:
+        result.single_copy_counts()
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class BuscoCatalog:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(str(self.path))
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CATALOG_VERSION:
+            with self.db:
+                self.db.execute("DROP TABLE IF EXISTS assemblies")
+                self.db.execute("DROP TABLE IF EXISTS id_tables")
+                self.db.executescript(SCHEMA)
+                self.db.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, results_folder, threads=8):
+        """
+        Reads new or changed assemblies of the results folder, and forgets
+        the ones that are gone. Returns the number of assemblies read and removed
+        """
+        results_folder = Path(results_folder)
+        known = {assembly: (location, mtime) for assembly, location, mtime in
+            self.db.execute("SELECT assembly, location, mtime_ns FROM assemblies")}
+
+        present = set()
+        changed = list()
+        for folder in sorted(results_folder.iterdir()):
+            if not folder.is_dir():
+                continue
+            present.add(folder.name)
+            entry = known.get(folder.name)
+            if entry is not None and mtime_ns(results_folder / entry[0]) == entry[1]:
+                continue
+            changed.append(folder)
+
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            results = list(executor.map(read_result, changed))
+
+        removed = set(known) - present
+        with self.db:
+            for assembly in removed:
+                self.db.execute("DELETE FROM assemblies WHERE assembly = ?", (assembly,))
+            for folder, result in zip(changed, results):
+                if result is None:
+                    print("Warning: Can't find BUSCO results in {}".format(folder))
+                    self.db.execute("DELETE FROM assemblies WHERE assembly = ?", (folder.name,))
+                    continue
+                self.add(results_folder, result)
+        return len(changed), len(removed)
+
+    def id_table(self, ids):
+        """
+        Row id of a list of BUSCO ids (added if it's new)
+        """
+        ids = "\t".join(ids)
+        row = self.db.execute("SELECT id FROM id_tables WHERE ids = ?", (ids,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.db.execute("INSERT INTO id_tables (ids) VALUES (?)", (ids,)).lastrowid
+
+    def add(self, results_folder, result):
+        location = result.location
+        reported = result.reported if result.reported is not None else (None,)*5
+        counted_files = result.counted_files if result.counted_files is not None else (None, None, None)
+        sequences = None
+        if result.sequences is not None:
+            sequences = result.sequences.relative_to(results_folder).as_posix()
+        others = None
+        if counted_files[2] is not None:
+            others = "\t".join(counted_files[2])
+
+        self.db.execute("INSERT OR REPLACE INTO assemblies VALUES \
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (result.assembly,
+            location.relative_to(results_folder).as_posix(), mtime_ns(location),
+            result.archive is not None, sequences, *reported,
+            self.id_table(result.ids), result.codes, counted_files[0],
+            counted_files[1], others))
+
+    def results(self, results_folder, assemblies=None):
+        """
+        Returns a dictionary of assembly -> BuscoResult, sorted by assembly.
+        Only the given assemblies if 'assemblies' is used
+        """
+        results_folder = Path(results_folder)
+        id_tables = {n: ids.split("\t") if ids else list() for n, ids in
+            self.db.execute("SELECT id, ids FROM id_tables")}
+
+        results = dict()
+        for row in self.db.execute("SELECT * FROM assemblies ORDER BY assembly"):
+            (assembly, location, _, archive, sequences, C, S, D, F, M,
+                id_table, codes, fna, faa, others) = row
+            if assemblies is not None and assembly not in assemblies:
+                continue
+
+            location = results_folder / location
+            reported = None if C is None else (C, S, D, F, M)
+            counted_files = None
+            if fna is not None:
+                counted_files = (fna, faa, others.split("\t") if others else list())
+            if sequences is not None:
+                sequences = results_folder / sequences
+
+            results[assembly] = BuscoResult.restore(results_folder / assembly,
+                location if archive else None, None if archive else location,
+                sequences, reported, id_tables[id_table], codes, counted_files)
+        return results
+
+
+if __name__ == "__main__":
+    args = arg_parser()
+
+    if not args.buscofolders.is_dir():
+        sys.exit("Error: given input folder not a folder")
+
+    with BuscoCatalog(args.catalog) as catalog:
+        read, removed = catalog.update(args.buscofolders, args.threads)
+    print("Catalog updated: {} assemblies read, {} removed".format(read, removed))
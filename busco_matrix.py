@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+
+"""
+Binary format of the a/p matrix (steps 4 and 5).
+
+The file has a small header with the labels, followed by the matrix with one
+bit per cell (rows padded to whole bytes), so that it can be memory-mapped:
+* MAGIC
+* length of the header (8 bytes, little-endian)
+* header: json with "assemblies" (row labels) and "buscos" (column labels)
+* padding up to a multiple of 64 bytes
+* the bit-packed matrix (numpy.packbits of each row)
+
+Run this file to export a binary matrix as tsv:
+python busco_matrix.py busco_a-p_matrix.bin busco_a-p_matrix.tsv
+"""
+
+import sys
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+MAGIC = b"BUSCO_AP_MATRIX\n"
+ALIGNMENT = 64
+
+
+def is_binary_matrix(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_matrix(busco_table, path):
+    """
+    Saves a boolean dataframe (rows: assemblies, columns: BUSCOs)
+    """
+    header = json.dumps({"assemblies": [str(x) for x in busco_table.index],
+        "buscos": [str(x) for x in busco_table.columns]}).encode("utf-8")
+    start = len(MAGIC) + 8 + len(header)
+    padding = -start % ALIGNMENT
+
+    packed = np.packbits(busco_table.to_numpy(dtype=bool), axis=1)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(b"\0" * padding)
+        f.write(packed.tobytes())
+
+
+def load_matrix(path):
+    """
+    Returns the boolean dataframe saved with save_matrix(). The bits are
+    memory-mapped and only unpacked once
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a binary a/p matrix".format(path))
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+
+    assemblies = header["assemblies"]
+    buscos = header["buscos"]
+    start = len(MAGIC) + 8 + header_length
+    start += -start % ALIGNMENT
+    row_bytes = (len(buscos) + 7) // 8
+
+    if len(assemblies) == 0 or row_bytes == 0:
+        matrix = np.zeros((len(assemblies), len(buscos)), dtype=bool)
+    else:
+        packed = np.memmap(path, dtype=np.uint8, mode="r", offset=start,
+            shape=(len(assemblies), row_bytes))
+        matrix = np.unpackbits(packed, axis=1, count=len(buscos)).view(bool)
+    return pd.DataFrame(matrix, index=assemblies, columns=buscos)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: busco_matrix.py [binary matrix] [output tsv]")
+    load_matrix(sys.argv[1]).to_csv(sys.argv[2], sep="\t")
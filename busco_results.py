@@ -0,0 +1,283 @@
+"""
+Reads the results of the BUSCO run of one assembly, in any of the layouts
+left by step 2:
+* the run folder as written by BUSCO
+* the run folder with busco_sequences (and hmmer_output) compressed
+* a single archive per assembly (step 2, --pack)
+
+The status of every BUSCO id is read from full_table.tsv, and the reported
+numbers from short_summary.json (BUSCO 5). short_summary.txt is only used if
+the json file is missing or doesn't have the numbers (BUSCO 4 and early
+BUSCO 5 only report percentages).
+
+Statuses are kept as one character per BUSCO id ('S', 'D', 'F' or 'M'), in
+the order of a table of ids shared by all the results of the same dataset.
+"""
+
+import json
+from pathlib import Path
+from zipfile import ZipFile
+from busco_archive import ARCHIVE_NAME, SINGLE_COPY_FOLDER, BuscoArchive, read_statuses
+
+STATUS_CODES = {"Complete": "S", "Duplicated": "D", "Fragmented": "F", "Missing": "M"}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+
+# keys of short_summary.json with the numbers of C, S, D, F and M
+JSON_COUNTS = ("Complete BUSCOs", "Single copy BUSCOs", "Multi copy BUSCOs",
+    "Fragmented BUSCOs", "Missing BUSCOs")
+
+# key: tuple of BUSCO ids. value: (tuple of BUSCO ids, dict of id -> position)
+_id_tables = dict()
+
+
+def id_table(ids):
+    """
+    Returns the shared table for this (sorted) list of BUSCO ids
+    """
+    ids = tuple(ids)
+    table = _id_tables.get(ids)
+    if table is None:
+        table = (ids, {busco_id: n for n, busco_id in enumerate(ids)})
+        _id_tables[ids] = table
+    return table
+
+
+def read_summary_lines(lines):
+    """
+    Returns the C, S, D, F, M numbers from the lines of a short_summary file.
+    ValueError if the file doesn't have them
+    """
+    # NOTE: In BUSCO 4, line with "Complete BUSCOs" is 9, but for
+    # BUSCO 5, it's line 10!
+    for n, l in enumerate(lines):
+        if l.strip().endswith("Complete BUSCOs (C)"):
+            break
+    else:
+        raise ValueError("no BUSCO numbers in summary")
+    if len(lines) < n + 5:
+        raise ValueError("incomplete BUSCO numbers in summary")
+    return tuple(int(l.strip().split("\t")[0]) for l in lines[n:n+5])
+
+
+def read_summary_json(text):
+    """
+    Returns the C, S, D, F, M numbers from a short_summary.json file.
+    ValueError if the file doesn't have them
+    """
+    results = json.loads(text).get("results", dict())
+    if not all(key in results for key in JSON_COUNTS):
+        raise ValueError("no BUSCO numbers in json summary")
+    return tuple(int(results[key]) for key in JSON_COUNTS)
+
+
+class BuscoResult:
+    """
+    Summary numbers and status of every BUSCO id of one assembly.
+    FileNotFoundError if the folder doesn't have BUSCO results
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.assembly = self.folder.name
+        self.archive = None # single archive (step 2, --pack)
+        self.run_folder = None
+        self.sequences = None # busco_sequences folder or zip file. None if missing
+        self.reported = None # (C, S, D, F, M) from the summary. None if missing
+        self.counted_files = None # see single_copy_counts()
+
+        archive_path = self.folder / ARCHIVE_NAME
+        if archive_path.is_file():
+            self.archive = archive_path
+            self.sequences = archive_path
+            with BuscoArchive(archive_path) as archive:
+                # the index has no statuses if the run had no full_table.tsv
+                self.read_run(lambda name: archive.read(name).decode("utf-8"), 
+                    archive.statuses or None)
+            return
+
+        run_folders = [x for x in self.folder.glob("run_*") if x.is_dir()]
+        if not run_folders:
+            raise FileNotFoundError("No BUSCO run folder in {}".format(self.folder))
+        self.run_folder = sorted(run_folders)[0]
+
+        if (self.run_folder / "busco_sequences.zip").is_file():
+            self.sequences = self.run_folder / "busco_sequences.zip"
+        elif (self.run_folder / SINGLE_COPY_FOLDER).is_dir():
+            self.sequences = self.run_folder / "busco_sequences"
+
+        def read_file(name):
+            try:
+                with open(self.run_folder / name) as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise KeyError(name)
+
+        try:
+            statuses = read_statuses(read_file("full_table.tsv"))
+        except KeyError:
+            statuses = None
+        self.read_run(read_file, statuses)
+
+    @classmethod
+    def restore(cls, folder, archive, run_folder, sequences, reported, ids, codes, counted_files):
+        """
+        Result saved before (see busco_catalog.py), without reading the folder.
+        Paths are absolute (or relative to the working directory)
+        """
+        result = cls.__new__(cls)
+        result.folder = Path(folder)
+        result.assembly = result.folder.name
+        result.archive = archive
+        result.run_folder = run_folder
+        result.sequences = sequences
+        result.reported = reported
+        result.counted_files = counted_files
+        result.ids, result.positions = id_table(ids)
+        result.codes = codes
+        return result
+
+    @property
+    def location(self):
+        return self.archive if self.archive is not None else self.run_folder
+
+    def read_run(self, read_file, statuses):
+        """
+        read_file: returns the text of a file of the run (KeyError if missing)
+        statuses: BUSCO id -> status, from full_table.tsv. None if missing
+        """
+        try:
+            self.reported = read_summary_json(read_file("short_summary.json"))
+        except (KeyError, ValueError):
+            try:
+                self.reported = read_summary_lines(read_file("short_summary.txt").splitlines())
+            except (KeyError, ValueError):
+                self.reported = None
+
+        # without full_table.tsv, the single-copy sequences are all we know
+        if statuses is None:
+            statuses = dict()
+            if self.sequences is not None:
+                for name in self.single_copy_files():
+                    statuses[name.rsplit(".", 1)[0]] = "Complete"
+
+        self.ids, self.positions = id_table(sorted(statuses))
+        self.codes = "".join(STATUS_CODES.get(statuses[busco_id], "M") for busco_id in self.ids)
+
+    def status(self, busco_id):
+        """
+        'Complete', 'Duplicated', 'Fragmented' or 'Missing'. None if the id
+        is not in the results
+        """
+        n = self.positions.get(busco_id)
+        if n is None:
+            return None
+        return STATUS_NAMES[self.codes[n]]
+
+    def ids_with(self, status):
+        code = STATUS_CODES[status]
+        return [busco_id for busco_id, c in zip(self.ids, self.codes) if c == code]
+
+    def counts(self):
+        """
+        C, S, D, F, M numbers from the status of every BUSCO id
+        """
+        S = self.codes.count("S")
+        D = self.codes.count("D")
+        return S + D, S, D, self.codes.count("F"), self.codes.count("M")
+
+    def single_copy_files(self):
+        """
+        Names of the files in the single-copy sequences folder.
+        FileNotFoundError if the sequences are missing
+        """
+        if self.sequences is None:
+            raise FileNotFoundError("No BUSCO sequences in {}".format(self.folder))
+
+        if self.archive is not None:
+            with BuscoArchive(self.archive) as archive:
+                names = archive.names(SINGLE_COPY_FOLDER)
+        elif self.sequences.suffix == ".zip":
+            with ZipFile(self.sequences) as z:
+                names = [x for x in z.namelist() if x.startswith(SINGLE_COPY_FOLDER)]
+        else:
+            return [x.name for x in (self.run_folder / SINGLE_COPY_FOLDER).iterdir()]
+        return [x[len(SINGLE_COPY_FOLDER):] for x in names if len(x) > len(SINGLE_COPY_FOLDER)]
+
+    def single_copy_counts(self):
+        """
+        Number of fna and faa files in the single-copy sequences folder, and
+        names of any other files. FileNotFoundError if the sequences are missing
+        """
+        if self.counted_files is None:
+            fna = 0
+            faa = 0
+            others = list()
+            for name in self.single_copy_files():
+                if name[-3:] == "fna":
+                    fna += 1
+                elif name[-3:] == "faa":
+                    faa += 1
+                else:
+                    others.append(name)
+            self.counted_files = (fna, faa, others)
+        return self.counted_files
+
+    def open_sequences(self):
+        """
+        Opens the sequences (zip file or archive) once, to read many of them.
+        Use as a context manager
+        """
+        return SequenceReader(self)
+
+    def single_copy(self, busco_id, suffix):
+        """
+        Text of the single-copy sequence file of a BUSCO id ('fna' or 'faa').
+        KeyError if it's missing
+        """
+        with self.open_sequences() as reader:
+            return reader.single_copy(busco_id, suffix)
+
+
+class SequenceReader:
+    """
+    Reads single-copy sequences of a BuscoResult, keeping its zip file or
+    archive open
+    """
+    def __init__(self, result):
+        self.result = result
+        self.archive = None
+        self.zip = None
+        if result.archive is not None:
+            self.archive = BuscoArchive(result.archive)
+        elif result.sequences is not None and result.sequences.suffix == ".zip":
+            self.zip = ZipFile(result.sequences)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+        if self.zip is not None:
+            self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def single_copy(self, busco_id, suffix):
+        """
+        Text of the single-copy sequence file of a BUSCO id ('fna' or 'faa').
+        KeyError if it's missing
+        """
+        if self.archive is not None:
+            return self.archive.single_copy(busco_id, suffix)
+        if self.result.sequences is None:
+            raise KeyError(busco_id)
+
+        name = "{}{}.{}".format(SINGLE_COPY_FOLDER, busco_id, suffix)
+        if self.zip is not None:
+            return self.zip.read(name).decode("utf-8")
+        try:
+            with open(self.result.run_folder / name) as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(busco_id)
@@ -0,0 +1,156 @@
+"""
+Reading and writing of fasta files (steps 6 and 8).
+
+Records are parsed from large chunks of bytes instead of line by line, and
+sequences are wrapped with one slice per line, written a block of lines at
+a time (the whole sequence is never copied into a new string). Binary
+sequences (bytes or numpy arrays of characters) are wrapped with numpy.
+
+The layout is the same as the one used before by steps 6 and 8: 80
+columns per line, and an empty line before sequences shorter than a line.
+The latter is kept so that the outputs don't change.
+
+See fasta_io_benchmark.py for a comparison with the previous code.
+"""
+
+import numpy as np
+
+WIDTH = 80
+CHUNK_SIZE = 1024*1024
+
+
+def wrap(seq, width=WIDTH):
+    """
+    Returns the sequence with 'width' characters per line (for short
+    sequences that are kept as text; use write_sequence() to write to a file)
+    """
+    lines = [seq[i:i+width] for i in range(0, len(seq), width)]
+    if len(seq) < width:
+        lines.insert(0, "")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def write_sequence(f, seq, width=WIDTH, block_lines=1024):
+    """
+    Writes the sequence to a text file, with 'width' characters per line.
+    Lines are joined 'block_lines' at a time, so no copy of the whole 
+    sequence is made
+    """
+    if len(seq) < width:
+        f.write("\n")
+    block = width * block_lines
+    for start in range(0, len(seq), block):
+        end = min(start + block, len(seq))
+        f.write("\n".join([seq[i:i+width] for i in range(start, end, width)]))
+        f.write("\n")
+
+
+def write_sequence_bytes(f, seq, width=WIDTH):
+    """
+    Same as write_sequence(), for a file opened in binary mode and a
+    sequence in bytes (or a numpy array of uint8 characters)
+    """
+    seq = np.frombuffer(seq, dtype=np.uint8) if not isinstance(seq, np.ndarray) else seq
+    length = len(seq)
+    if length < width:
+        f.write(b"\n")
+
+    full_lines = length // width
+    if full_lines:
+        lines = np.empty((full_lines, width + 1), dtype=np.uint8)
+        lines[:, :width] = seq[:full_lines*width].reshape(full_lines, width)
+        lines[:, width] = ord("\n")
+        f.write(lines.tobytes())
+    if length % width:
+        f.write(seq[full_lines*width:].tobytes())
+        f.write(b"\n")
+
+
+def split_record(data):
+    """
+    Header (without '>') and sequence (bytes, without whitespace) of the
+    bytes of one record
+    """
+    data = data.lstrip()
+    if data.startswith(b">"):
+        data = data[1:]
+    header, _, seq = data.partition(b"\n")
+    seq = seq.replace(b"\n", b"")
+    # other whitespace is rare (e.g. '\r' in files from Windows)
+    if b" " in seq or b"\r" in seq or b"\t" in seq:
+        seq = b"".join(seq.split())
+    return header.decode("utf-8").strip(), seq
+
+
+def raw_records(chunks):
+    """
+    Yields the bytes of each record from consecutive pieces (bytes) of a 
+    fasta file. Empty lines before the first record are skipped
+    """
+    pending = list() # pieces of the current record
+    for chunk in chunks:
+        # a record starting right at the beginning of this chunk
+        if pending and pending[-1].endswith(b"\n") and chunk.startswith(b">"):
+            yield b"".join(pending)
+            pending = list()
+            chunk = chunk[1:]
+
+        parts = chunk.split(b"\n>")
+        pending.append(parts[0])
+        for part in parts[1:]:
+            yield b"".join(pending)
+            pending = [part]
+
+    yield b"".join(pending)
+
+
+def records(chunks, as_bytes=False):
+    """
+    Yields (header, sequence) from consecutive pieces (bytes) of a fasta file.
+    Sequences are bytes if 'as_bytes' is used
+    """
+    for data in raw_records(chunks):
+        if not data.strip():
+            continue
+        header, seq = split_record(data)
+        yield header, seq if as_bytes else seq.decode("utf-8")
+
+
+def file_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+
+def read_fasta(path, as_bytes=False, chunk_size=CHUNK_SIZE):
+    """
+    Yields (header, sequence) for every record of a fasta file. Headers
+    don't include '>'. Sequences are bytes if 'as_bytes' is used
+    """
+    yield from records(file_chunks(path, chunk_size), as_bytes)
+
+
+def read_lengths(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields (header, sequence length) for every record of a fasta file,
+    without keeping the sequences
+    """
+    for data in raw_records(file_chunks(path, chunk_size)):
+        if not data.strip():
+            continue
+        data = data.lstrip()
+        if data.startswith(b">"):
+            data = data[1:]
+        header, _, seq = data.partition(b"\n")
+        if b" " in seq or b"\r" in seq or b"\t" in seq:
+            length = len(b"".join(seq.split()))
+        else:
+            length = len(seq) - seq.count(b"\n")
+        yield header.decode("utf-8").strip(), length
+
+
+def parse_fasta(text):
+    """
+    Same as read_fasta(), from a string
+    """
+    return records([text.encode("utf-8")])
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+"""
+Micro-benchmark of fasta_io.py against the code it replaced in steps 6 and 8
+(sequence80() and the line by line reader), on a supermatrix-like file.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import fasta_io
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--taxa", help="Number of sequences. Default: 200",
+        type=int, default=200)
+    parser.add_argument("--columns", help="Length of each sequence. Default: \
+        1000000", type=int, default=1000000)
+    return parser.parse_args()
+
+
+def old_sequence80(seq):
+    length = len(seq)
+    part_one = "\n".join([seq[row*80:(row+1)*80] for row in \
+            range(length // 80)])
+
+    part_two = ""
+    remainder = length % 80
+    if remainder > 0:
+        part_two = "{}\n".format(seq[-remainder:])
+    return "{}\n{}".format(part_one, part_two)
+
+
+def old_read_fasta(path):
+    records = list()
+    with open(path) as f:
+        header = ""
+        sequence = list()
+        for line in f:
+            if line.strip() == "":
+                continue
+            if line[0] == ">":
+                if header != "":
+                    records.append((header, "".join(sequence)))
+                    sequence = list()
+                header = line[1:].strip()
+            else:
+                sequence.append(line.strip())
+        records.append((header, "".join(sequence)))
+    return records
+
+
+def timed(label, function, baseline=None):
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    speedup = "" if baseline is None else "\t({:.1f}x)".format(baseline / seconds)
+    print("{:<40}{:.2f} s{}".format(label, seconds, speedup))
+    return seconds, result
+
+
+if __name__ == "__main__":
+    args = arg_parser()
+
+    rng = np.random.default_rng(0)
+    alphabet = np.frombuffer(b"ACGT-", dtype=np.uint8)
+    sequences = [alphabet[rng.integers(0, 5, args.columns)] for _ in range(args.taxa)]
+    texts = [s.tobytes().decode("ascii") for s in sequences]
+    print("{} sequences of {} columns".format(args.taxa, args.columns))
+
+    with tempfile.TemporaryDirectory() as folder:
+        old_file = os.path.join(folder, "old.fasta")
+        new_file = os.path.join(folder, "new.fasta")
+        bytes_file = os.path.join(folder, "bytes.fasta")
+
+        def write_old():
+            with open(old_file, "w") as f:
+                for n, seq in enumerate(texts):
+                    f.write(">taxon_{}\n".format(n))
+                    f.write(old_sequence80(seq))
+
+        def write_new():
+            with open(new_file, "w") as f:
+                for n, seq in enumerate(texts):
+                    f.write(">taxon_{}\n".format(n))
+                    fasta_io.write_sequence(f, seq)
+
+        def write_bytes():
+            with open(bytes_file, "wb") as f:
+                for n, seq in enumerate(sequences):
+                    f.write(">taxon_{}\n".format(n).encode("ascii"))
+                    fasta_io.write_sequence_bytes(f, seq)
+
+        baseline, _ = timed("write: sequence80", write_old)
+        timed("write: fasta_io.write_sequence", write_new, baseline)
+        timed("write: fasta_io.write_sequence_bytes", write_bytes, baseline)
+
+        for path in (new_file, bytes_file):
+            with open(old_file, "rb") as a, open(path, "rb") as b:
+                if a.read() != b.read():
+                    sys.exit("Error: {} is different".format(path))
+
+        baseline, old_records = timed("read: line by line", lambda: old_read_fasta(old_file))
+        _, new_records = timed("read: fasta_io.read_fasta",
+            lambda: list(fasta_io.read_fasta(old_file)), baseline)
+        if old_records != new_records:
+            sys.exit("Error: different records")
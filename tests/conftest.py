@@ -0,0 +1,16 @@
+import sys
+import importlib.util
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+
+def load_script(filename):
+    """
+    Imports a numbered step script (e.g. 7_align_Target_Genes.py) as a module
+    """
+    spec = importlib.util.spec_from_file_location(Path(filename).stem, REPO / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,48 @@
+from collections import Counter
+
+import pytest
+
+from conftest import load_script
+
+
+@pytest.fixture(scope="module")
+def step7():
+    return load_script("7_align_Target_Genes.py")
+
+
+def test_most_expensive_first(step7):
+    jobs = [(10, "small"), (1000, "giant"), (100, "medium")]
+    assert [fasta for fasta, _ in step7.schedule(jobs, 4)] == ["giant", "medium", "small"]
+
+
+def test_giants_get_threads_in_large_sets(step7):
+    # many genes of similar cost and a few that are 10x the median: the giants
+    # must get several threads and the rest (almost) one
+    jobs = [(1000 + n % 200, "gene_{}".format(n)) for n in range(1500)]
+    jobs += [(11000, "giant_{}".format(n)) for n in range(3)]
+
+    for cores in (16, 64):
+        max_threads = cores // 4
+        scheduled = step7.schedule(jobs, max_threads)
+        threads = dict(scheduled)
+        assert [fasta for fasta, _ in scheduled[:3]] == ["giant_0", "giant_1", "giant_2"]
+        assert all(threads["giant_{}".format(n)] == max_threads for n in range(3))
+        counts = Counter(threads.values())
+        assert counts[1] >= 1400
+
+
+def test_threads_are_clamped(step7):
+    assert step7.threads_for_gene(0, 100, 8) == 1
+    assert step7.threads_for_gene(1, 100, 8) == 1
+    assert step7.threads_for_gene(50, 100, 8) == 4
+    assert step7.threads_for_gene(100, 100, 8) == 8
+    # nothing to align
+    assert step7.threads_for_gene(0, 0, 8) == 1
+    assert step7.schedule([], 8) == []
+
+
+def test_alignment_cost(step7, tmp_path):
+    fasta = tmp_path / "gene.fasta"
+    fasta.write_text(">a desc\nACGT\nAC\n>b\nACGTACGT\n>c\n")
+    # 3 sequences x mean length 14/3
+    assert step7.alignment_cost(fasta) == 14
@@ -0,0 +1,59 @@
+from zipfile import ZipFile, BadZipFile, ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
+from busco_archive import BuscoArchive, pack_run, SINGLE_COPY_FOLDER
+
+FULL_TABLE = """# BUSCO version is: 5.2.2
+# Busco id\tStatus\tSequence
+1at4890\tComplete\tcontig_1
+2at4890\tDuplicated\tcontig_2
+2at4890\tDuplicated\tcontig_3
+3at4890\tMissing
+"""
+
+
+@pytest.fixture
+def run_folder(tmp_path):
+    run = tmp_path / "run_test_odb10"
+    run.mkdir()
+    (run / "full_table.tsv").write_text(FULL_TABLE)
+    (run / "short_summary.txt").write_text("summary\n")
+    (run / "hmmer_output").mkdir()
+    (run / "hmmer_output" / "1at4890.out").write_text("hmmer\n" * 100)
+    # step 2 leaves the sequences compressed in the run folder
+    with ZipFile(run / "busco_sequences.zip", "w") as z:
+        z.writestr(SINGLE_COPY_FOLDER + "1at4890.fna", ">contig_1\nACGT\n")
+        z.writestr(SINGLE_COPY_FOLDER + "1at4890.faa", ">contig_1\nMK\n")
+    return run
+
+
+@pytest.mark.parametrize("compression", [ZIP_DEFLATED, ZIP_STORED])
+def test_pack_and_read(run_folder, tmp_path, compression):
+    archive = tmp_path / "busco_run.zip"
+    pack_run(run_folder, archive, compression)
+
+    with BuscoArchive(archive) as a:
+        assert a.run_name == "run_test_odb10"
+        assert a.statuses == {"1at4890": "Complete", "2at4890": "Duplicated", "3at4890": "Missing"}
+        assert a.read("full_table.tsv").decode("utf-8") == FULL_TABLE
+        assert a.read("hmmer_output/1at4890.out") == b"hmmer\n" * 100
+        assert a.single_copy("1at4890", "fna") == ">contig_1\nACGT\n"
+        assert a.single_copy("1at4890", "faa") == ">contig_1\nMK\n"
+        assert sorted(a.names(SINGLE_COPY_FOLDER)) == [SINGLE_COPY_FOLDER + "1at4890.faa",
+            SINGLE_COPY_FOLDER + "1at4890.fna"]
+        with pytest.raises(KeyError):
+            a.single_copy("3at4890", "fna")
+
+    # still a valid zip file, with the same contents
+    with ZipFile(archive) as z:
+        assert z.testzip() is None
+        assert z.read("hmmer_output/1at4890.out") == b"hmmer\n" * 100
+
+
+def test_not_an_archive(tmp_path):
+    plain = tmp_path / "plain.zip"
+    with ZipFile(plain, "w") as z:
+        z.writestr("a.txt", "a")
+    with pytest.raises(BadZipFile):
+        BuscoArchive(plain)
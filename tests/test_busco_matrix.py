@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from busco_matrix import is_binary_matrix, save_matrix, load_matrix
+
+
+def random_matrix(assemblies, buscos, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.random((assemblies, buscos)) < 0.7,
+        index=["GCA_{}.1".format(n) for n in range(assemblies)],
+        columns=["{}at4890".format(n) for n in range(buscos)])
+
+
+def test_round_trip(tmp_path):
+    # 13 columns: rows don't end at a whole byte
+    for assemblies, buscos in ((5, 13), (1, 8), (20, 1000)):
+        matrix = random_matrix(assemblies, buscos)
+        path = tmp_path / "matrix_{}x{}.bin".format(assemblies, buscos)
+        save_matrix(matrix, path)
+
+        assert is_binary_matrix(path)
+        loaded = load_matrix(path)
+        assert list(loaded.index) == list(matrix.index)
+        assert list(loaded.columns) == list(matrix.columns)
+        assert loaded.dtypes.eq(bool).all()
+        assert (loaded.to_numpy() == matrix.to_numpy()).all()
+
+
+def test_empty_matrix(tmp_path):
+    path = tmp_path / "empty.bin"
+    save_matrix(random_matrix(3, 0), path)
+    loaded = load_matrix(path)
+    assert loaded.shape == (3, 0)
+    assert list(loaded.index) == ["GCA_0.1", "GCA_1.1", "GCA_2.1"]
+
+
+def test_tsv_is_not_binary(tmp_path):
+    path = tmp_path / "matrix.tsv"
+    random_matrix(2, 3).to_csv(path, sep="\t")
+    assert not is_binary_matrix(path)
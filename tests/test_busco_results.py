@@ -0,0 +1,87 @@
+import shutil
+from zipfile import ZipFile
+
+import pytest
+
+from busco_archive import ARCHIVE_NAME, SINGLE_COPY_FOLDER, pack_run
+from busco_results import BuscoResult, read_summary_lines
+
+SUMMARY = """# BUSCO version is: 4.0.6
+# Summarized benchmarking in BUSCO notation for file genome.fasta
+	***** Results: *****
+
+	C:66.7%[S:33.3%,D:33.3%],F:0.0%,M:33.3%,n:3
+	2	Complete BUSCOs (C)
+	1	Complete and single-copy BUSCOs (S)
+	1	Complete and duplicated BUSCOs (D)
+	0	Fragmented BUSCOs (F)
+	1	Missing BUSCOs (M)
+	3	Total BUSCO groups searched
+"""
+
+
+def make_run(assembly_folder, full_table=True, summary=SUMMARY):
+    run = assembly_folder / "run_test_odb10"
+    run.mkdir(parents=True)
+    if full_table:
+        (run / "full_table.tsv").write_text("# Busco id\tStatus\n"
+            "1at1\tComplete\n2at1\tDuplicated\n3at1\tMissing\n")
+    if summary is not None:
+        (run / "short_summary.txt").write_text(summary)
+    with ZipFile(run / "busco_sequences.zip", "w") as z:
+        z.writestr(SINGLE_COPY_FOLDER + "1at1.fna", ">c1\nACGT\n")
+        z.writestr(SINGLE_COPY_FOLDER + "1at1.faa", ">c1\nMK\n")
+    return run
+
+
+def pack(assembly_folder):
+    run = assembly_folder / "run_test_odb10"
+    pack_run(run, assembly_folder / ARCHIVE_NAME)
+    shutil.rmtree(run)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_result(tmp_path, packed):
+    folder = tmp_path / "GCA_1.1"
+    make_run(folder)
+    if packed:
+        pack(folder)
+
+    result = BuscoResult(folder)
+    assert result.reported == (2, 1, 1, 0, 1)
+    assert result.ids_with("Complete") == ["1at1"]
+    assert result.status("2at1") == "Duplicated"
+    assert result.single_copy("1at1", "faa") == ">c1\nMK\n"
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_without_full_table(tmp_path, packed):
+    # the single-copy sequences are the only statuses left, in every layout
+    folder = tmp_path / "GCA_1.1"
+    make_run(folder, full_table=False)
+    if packed:
+        pack(folder)
+
+    result = BuscoResult(folder)
+    assert result.ids_with("Complete") == ["1at1"]
+    assert result.counts() == (1, 1, 0, 0, 0)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_summary_without_numbers(tmp_path, packed):
+    folder = tmp_path / "GCA_1.1"
+    make_run(folder, summary="# BUSCO version is: 4.0.6\n")
+    if packed:
+        pack(folder)
+
+    result = BuscoResult(folder)
+    assert result.reported is None
+    assert result.ids_with("Complete") == ["1at1"]
+
+
+def test_read_summary_lines():
+    assert read_summary_lines(SUMMARY.splitlines()) == (2, 1, 1, 0, 1)
+    with pytest.raises(ValueError):
+        read_summary_lines(["no numbers here"])
+    with pytest.raises(ValueError):
+        read_summary_lines(SUMMARY.splitlines()[:7])
@@ -0,0 +1,122 @@
+import sys
+import subprocess
+
+import pytest
+
+from conftest import REPO, load_script
+from fasta_io import read_fasta
+
+
+@pytest.fixture(scope="module")
+def step8():
+    return load_script("8_concatenate_alignments.py")
+
+
+def write_alignment(folder, gene_id, records):
+    """
+    records: (accession, sequence) pairs. An empty sequence is an empty record
+    """
+    with open(folder / "{}.algn".format(gene_id), "w") as f:
+        for acc, seq in records:
+            f.write(">{}_{} description\n{}\n".format(gene_id, acc, seq))
+
+
+@pytest.fixture
+def alignments(tmp_path):
+    folder = tmp_path / "alignments"
+    folder.mkdir()
+    # GCA_2.1 is missing from 1at1 and has an empty record in 3at1; GCA_4.1
+    # only has empty records; 2at1 has no sequences at all
+    write_alignment(folder, "1at1", [("GCA_1.1", "ACGT"), ("GCA_3.1", "AC-T"), ("GCA_4.1", "")])
+    write_alignment(folder, "2at1", [("GCA_1.1", ""), ("GCA_2.1", "")])
+    write_alignment(folder, "3at1", [("GCA_2.1", ""), ("GCA_1.1", "GGGAAA"), 
+        ("GCA_3.1", "------"), ("GCA_4.1", "")])
+    write_alignment(folder, "4at1", [("GCA_2.1", "TT"), ("GCA_3.1", "TA"), ("GCA_1.1", "?-")])
+    return folder
+
+
+def run_step8(folder, name, *options):
+    return subprocess.run([sys.executable, str(REPO / "8_concatenate_alignments.py"),
+        "-i", str(folder), "-n", str(name), *options], 
+        capture_output=True, encoding="utf-8", check=True)
+
+
+def test_scan_alignment(step8, alignments):
+    assert step8.scan_alignment(alignments / "1at1.algn") == ("1at1", ["GCA_1.1", "GCA_3.1", "GCA_4.1"], 4)
+    assert step8.scan_alignment(alignments / "2at1.algn") == ("2at1", ["GCA_1.1", "GCA_2.1"], 0)
+
+
+def test_gap_filling(alignments, tmp_path):
+    name = tmp_path / "concatenated"
+    proc = run_step8(alignments, name, "-f", "fasta", "phylip", "nexus")
+    assert "no sequences in" in proc.stdout and "2at1" in proc.stdout
+
+    # every accession, even the ones with only empty records
+    sequences = dict(read_fasta("{}.fasta".format(name)))
+    assert sequences == {
+        "GCA_1.1": "ACGT" + "GGGAAA" + "?-",
+        "GCA_3.1": "AC-T" + "------" + "TA",
+        "GCA_4.1": "----" + "------" + "--",
+        "GCA_2.1": "----" + "------" + "TT",
+        }
+    assert list(sequences) == ["GCA_1.1", "GCA_3.1", "GCA_4.1", "GCA_2.1"]
+
+    # the alignment without sequences has no partition
+    charsets = ["\tcharset\t1at1 = 1-4;", "\tcharset\t3at1 = 5-10;", "\tcharset\t4at1 = 11-12;"]
+    with open("{}.nex".format(name)) as f:
+        assert f.read() == "#nexus\nbegin sets;\n" + "\n".join(charsets) + "\nend;"
+    with open("{}.partitions".format(name)) as f:
+        assert f.read() == "GTR+G, 1at1 = 1-4\nGTR+G, 3at1 = 5-10\nGTR+G, 4at1 = 11-12\n"
+
+    with open("{}.phy".format(name)) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "4 12"
+    assert lines[1:] == ["{} {}".format(acc, seq) for acc, seq in sequences.items()]
+
+    with open("{}.nexus".format(name)) as f:
+        nexus = f.read()
+    assert "dimensions ntax=4 nchar=12;" in nexus
+    assert "format datatype=dna missing=? gap=-;" in nexus
+    assert "GCA_2.1 ----------TT\n" in nexus
+
+
+def test_occupancy(alignments, tmp_path):
+    name = tmp_path / "concatenated"
+    run_step8(alignments, name)
+
+    # only sequences with something other than '-' or '?' count
+    with open("{}_occupancy_taxa.tsv".format(name)) as f:
+        assert f.read().splitlines() == ["Assembly\tGenes\tOccupancy",
+            "GCA_1.1\t2\t0.6667", "GCA_3.1\t2\t0.6667", 
+            "GCA_4.1\t0\t0.0000", "GCA_2.1\t1\t0.3333"]
+    with open("{}_occupancy_genes.tsv".format(name)) as f:
+        assert f.read().splitlines() == ["Gene\tAssemblies\tOccupancy",
+            "1at1\t2\t0.5000", "3at1\t1\t0.2500", "4at1\t2\t0.5000"]
+
+
+def test_missing_char(alignments, tmp_path):
+    name = tmp_path / "concatenated"
+    run_step8(alignments, name, "--missing_char", "?")
+    sequences = dict(read_fasta("{}.fasta".format(name)))
+    assert sequences["GCA_2.1"] == "??????????TT"
+    assert sequences["GCA_3.1"] == "AC-T------TA"
+
+
+def test_full_alignments_keep_the_old_layout(tmp_path):
+    folder = tmp_path / "alignments"
+    folder.mkdir()
+    write_alignment(folder, "1at1", [("GCA_1.1", "A" * 100), ("GCA_2.1", "C" * 100)])
+    write_alignment(folder, "2at1", [("GCA_2.1", "G" * 30), ("GCA_1.1", "T" * 30)])
+    name = tmp_path / "concatenated"
+    run_step8(folder, name)
+    with open("{}.fasta".format(name)) as f:
+        assert f.read() == (">GCA_1.1\n" + "A" * 80 + "\n" + "A" * 20 + "T" * 30 + "\n" +
+            ">GCA_2.1\n" + "C" * 80 + "\n" + "C" * 20 + "G" * 30 + "\n")
+
+
+def test_no_sequences(tmp_path):
+    folder = tmp_path / "alignments"
+    folder.mkdir()
+    write_alignment(folder, "1at1", [("GCA_1.1", "")])
+    with pytest.raises(subprocess.CalledProcessError):
+        run_step8(folder, tmp_path / "concatenated")
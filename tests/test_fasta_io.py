@@ -0,0 +1,81 @@
+import io
+
+import numpy as np
+import pytest
+
+import fasta_io
+
+RECORDS = [
+    ("1at4890_GCA_0.1 first record", "ACGT" * 50),
+    ("1at4890_GCA_1.1", ""),
+    ("1at4890_GCA_2.1 short", "AC-GT"),
+    ("1at4890_GCA_3.1", "N" * 80),
+]
+
+
+def fasta_text(records, width=60):
+    text = list()
+    for header, seq in records:
+        text.append(">{}\n".format(header))
+        for i in range(0, len(seq), width):
+            text.append(seq[i:i+width] + "\n")
+    return "".join(text)
+
+
+def old_sequence80(seq):
+    """
+    Layout written by steps 6 and 8 before fasta_io
+    """
+    part_one = "\n".join([seq[row*80:(row+1)*80] for row in range(len(seq) // 80)])
+    part_two = ""
+    if len(seq) % 80 > 0:
+        part_two = "{}\n".format(seq[-(len(seq) % 80):])
+    return "{}\n{}".format(part_one, part_two)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 61, 62, 63, 1024*1024])
+def test_chunk_boundaries(tmp_path, chunk_size):
+    # every chunk size splits records, headers and the '\n>' separators at
+    # different places
+    path = tmp_path / "test.fasta"
+    path.write_text(fasta_text(RECORDS))
+    assert list(fasta_io.read_fasta(path, chunk_size=chunk_size)) == RECORDS
+    assert list(fasta_io.read_fasta(path, as_bytes=True, chunk_size=chunk_size)) == \
+        [(header, seq.encode("ascii")) for header, seq in RECORDS]
+    assert list(fasta_io.read_lengths(path, chunk_size=chunk_size)) == \
+        [(header, len(seq)) for header, seq in RECORDS]
+
+
+def test_blank_lines_and_windows_line_ends():
+    text = "\n\n" + fasta_text(RECORDS).replace("\n", "\r\n")
+    assert list(fasta_io.parse_fasta(text)) == RECORDS
+
+
+def test_records_from_pieces():
+    text = fasta_text(RECORDS).encode("ascii")
+    pieces = [text[i:i+5] for i in range(0, len(text), 5)]
+    assert list(fasta_io.records(pieces)) == RECORDS
+
+
+@pytest.mark.parametrize("length", [1, 79, 80, 81, 160, 161, 80*1024, 80*1024 + 1, 200000])
+def test_wrapping_keeps_the_old_layout(length):
+    seq = ("ACGT-" * (length // 5 + 1))[:length]
+    expected = old_sequence80(seq)
+    assert fasta_io.wrap(seq) == expected
+
+    text = io.StringIO()
+    fasta_io.write_sequence(text, seq)
+    assert text.getvalue() == expected
+
+    binary = io.BytesIO()
+    fasta_io.write_sequence_bytes(binary, np.frombuffer(seq.encode("ascii"), dtype=np.uint8))
+    assert binary.getvalue().decode("ascii") == expected
+
+
+def test_write_and_read_back(tmp_path):
+    path = tmp_path / "out.fasta"
+    with open(path, "w") as f:
+        for header, seq in RECORDS:
+            f.write(">{}\n".format(header))
+            fasta_io.write_sequence(f, seq)
+    assert list(fasta_io.read_fasta(path, chunk_size=17)) == RECORDS
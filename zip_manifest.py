@@ -0,0 +1,117 @@
+"""
+Keeps a manifest of the assembly zip files downloaded in step 1, so that
+later runs (of steps 1 and 2) don't need to open every zip file again.
+
+The manifest is a tab-separated file inside the assemblies folder with the
+following columns:
+zip file name, size, mtime (ns), uncompressed size of the .fna members,
+.fna members
+
+An entry is trusted as long as the size and mtime of the zip file don't
+change. Otherwise the central directory of the zip file is read (and
+checked) again; the contents of the members are never read.
+"""
+
+import os
+import threading
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+
+MANIFEST_NAME = "zip_manifest.tsv"
+
+
+class ZipManifest:
+    def __init__(self, folder):
+        self.path = Path(folder) / MANIFEST_NAME
+        self.entries = dict() # key: zip name. value: (size, mtime_ns, fna bytes, [fna members])
+        self.changed = False
+        self.lock = threading.Lock()
+
+        if not self.path.is_file():
+            return
+
+        with open(self.path) as f:
+            columns = None
+            for line in f:
+                if line[0] == "#":
+                    columns = line[1:].rstrip("\n").split("\t")
+                    continue
+                if line.strip() == "" or columns is None:
+                    continue
+                x = dict(zip(columns, line.rstrip("\n").split("\t")))
+                # entries of older manifests without all the columns (e.g.
+                # without fna_bytes) are checked again. The crc32 column of
+                # older manifests is ignored
+                if not all(c in x for c in ("zip", "size", "mtime_ns", "fna_bytes", "fna_members")):
+                    continue
+                members = [m for m in x["fna_members"].split(",") if m]
+                self.entries[x["zip"]] = (int(x["size"]), int(x["mtime_ns"]), 
+                    int(x["fna_bytes"]), members)
+
+    def check(self, zipfile):
+        """
+        Returns the list of .fna members of the zip file, or None if the zip
+        file is missing or can't be opened.
+        The zip file is only opened if it changed since it was recorded
+        """
+        try:
+            st = os.stat(zipfile)
+        except OSError:
+            return None
+
+        entry = self.entries.get(Path(zipfile).name)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[3]
+
+        return self.add(zipfile)
+
+    def genome_size(self, zipfile):
+        """
+        Uncompressed size of the .fna members of a zip file (0 if unknown). 
+        Use after check() or add()
+        """
+        entry = self.entries.get(Path(zipfile).name)
+        if entry is None:
+            return 0
+        return entry[2]
+
+    def add(self, zipfile):
+        """
+        Opens the zip file and records it in the manifest.
+        Returns the list of .fna members, or None if the zip file is not valid
+        """
+        name = Path(zipfile).name
+        try:
+            st = os.stat(zipfile)
+            with ZipFile(zipfile) as z:
+                infos = [info for info in z.infolist() if 
+                    info.filename.startswith("ncbi_dataset/data/") and 
+                    info.filename[-3:] == "fna"]
+            members = [info.filename for info in infos]
+            fna_bytes = sum(info.file_size for info in infos)
+        except (OSError, BadZipFile):
+            with self.lock:
+                if self.entries.pop(name, None) is not None:
+                    self.changed = True
+            return None
+
+        with self.lock:
+            self.entries[name] = (st.st_size, st.st_mtime_ns, fna_bytes, members)
+            self.changed = True
+        return members
+
+    def save(self):
+        if not self.changed:
+            return
+
+        with self.lock:
+            # write to a temporary file first to avoid a truncated manifest
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                f.write("#zip\tsize\tmtime_ns\tfna_bytes\tfna_members\n")
+                for name in sorted(self.entries):
+                    size, mtime_ns, fna_bytes, members = self.entries[name]
+                    f.write("{}\t{}\t{}\t{}\t{}\n".format(name, size, 
+                        mtime_ns, fna_bytes, ",".join(members)))
+            os.replace(tmp_path, self.path)
+            self.changed = False